@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Rows/sec of incremental bookmark filtering on a synthetic `payments` feed.
+
+`before` replays the original per-row logic (two dateutil parses in
+`needs_parse_to_date` plus two `strptime_with_tz` calls per comparison);
+`after` is the current `Stream.sync`.
+
+    $ python3 benchmarks/bench_bookmarks.py --rows 20000
+"""
+import argparse
+import datetime
+import time
+
+from dateutil.parser import parse
+from singer import utils
+
+from tap_clubspeed.clubspeed import PageSize
+from tap_clubspeed.streams import Payments
+
+
+def synthetic_payments(rows):
+    start = datetime.datetime(2018, 1, 1)
+    for payment_id in range(rows):
+        pay_date = start + datetime.timedelta(seconds=37 * payment_id)
+        yield {'paymentId': payment_id, 'payDate': pay_date.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}
+
+
+class FakeClient(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def page_size_for(self, stream_name, learned_limit=None):
+        return PageSize()
+
+    def payments(self, column_name=None, bookmark=None, page_size=None, fields=None):
+        return synthetic_payments(self.rows)
+
+
+def legacy_needs_parse_to_date(string):
+    if isinstance(string, str):
+        try:
+            parse(string)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+class LegacyPayments(Payments):
+    def update_bookmark(self, state, value):
+        current_bookmark = self.get_bookmark(state)
+        if value and legacy_needs_parse_to_date(value) and legacy_needs_parse_to_date(current_bookmark):
+            if utils.strptime_with_tz(value) > utils.strptime_with_tz(current_bookmark):
+                self.write(state, value)
+        elif current_bookmark is None:
+            self.write(state, value)
+
+    def is_bookmark_old(self, state, value):
+        current_bookmark = self.get_bookmark(state)
+        if current_bookmark is None:
+            return True
+        if legacy_needs_parse_to_date(current_bookmark) and legacy_needs_parse_to_date(value):
+            return utils.strptime_with_tz(value) >= utils.strptime_with_tz(current_bookmark)
+        return int(value) >= int(current_bookmark)
+
+    def write(self, state, value):
+        state.setdefault('bookmarks', {}).setdefault(self.name, {})[self.replication_key] = value
+
+
+def rows_per_second(stream_class, rows):
+    instance = stream_class(FakeClient(rows))
+    state = {'bookmarks': {'payments': {'payDate': '2017-12-31 00:00:00'}}}
+    started = time.perf_counter()
+    count = sum(1 for _ in instance.sync(state))
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    before = rows_per_second(LegacyPayments, args.rows)
+    after = rows_per_second(Payments, args.rows)
+    print('before: {:>10,.0f} rows/sec'.format(before))
+    print('after:  {:>10,.0f} rows/sec ({:.1f}x)'.format(after, after / before))
+
+
+if __name__ == '__main__':
+    main()
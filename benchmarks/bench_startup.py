@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Startup time of the tap: importing `tap_clubspeed` and discovering streams.
+
+Each run is a fresh interpreter, so nothing is cached between runs. It
+reports the median over --runs of the import, the first `discover_streams`
+call and a second (cached) one, in milliseconds.
+
+    $ python3 benchmarks/bench_startup.py --runs 10 --save startup.json
+    $ python3 benchmarks/bench_startup.py --runs 10 --baseline startup.json --max-regression 0.2
+
+With --baseline, the run exits non-zero if any step takes more than
+--max-regression longer than the baseline.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+PROBE = '''
+import json, time
+started = time.perf_counter()
+import tap_clubspeed
+imported = time.perf_counter()
+from tap_clubspeed.discover import discover_streams
+discover_streams(None)
+discovered = time.perf_counter()
+discover_streams(None)
+rediscovered = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000,
+                  'discover_ms': (discovered - imported) * 1000,
+                  'cached_discover_ms': (rediscovered - discovered) * 1000}))
+'''
+
+STEPS = ('import_ms', 'discover_ms', 'cached_discover_ms')
+
+
+def run_once():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    output = subprocess.check_output([sys.executable, '-c', PROBE], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def regressions(results, baseline, max_regression):
+    failures = []
+    for step in STEPS:
+        expected = baseline.get(step)
+        if expected and results[step] > expected * (1 + max_regression):
+            failures.append('{}: {:.1f}ms vs. baseline {:.1f}ms'.format(step, results[step], expected))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to time')
+    parser.add_argument('--save', help='write results as JSON to this path')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed fractional increase in time against the baseline')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    results = {step: statistics.median(run[step] for run in runs) for step in STEPS}
+    for step in STEPS:
+        print('{:<20} {:>8.1f}ms'.format(step, results[step]))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = regressions(results, json.load(f), args.max_regression)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
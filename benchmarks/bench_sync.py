@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput of `do_sync` against a local fake Clubspeed server.
+
+Every stream is synced from `fake_server.py` (run as a separate process so
+its CPU time is not counted) with Singer output written to /dev/null. For
+each stream it reports rows/sec, request count, peak RSS, and the CPU time
+spent in HTTP (request + decode), transformation and stdout serialisation.
+
+    $ python3 benchmarks/bench_sync.py --rows 5000 --save results.json
+    $ python3 benchmarks/bench_sync.py --rows 5000 --baseline results.json --max-regression 0.2
+
+With --baseline, the run exits non-zero if any stream's rows/sec falls more
+than --max-regression below the baseline.
+"""
+import argparse
+import collections
+import contextlib
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from unittest import mock
+
+from singer.catalog import Catalog
+
+import tap_clubspeed
+from tap_clubspeed import do_sync, get_client_options
+from tap_clubspeed.clubspeed import Clubspeed
+from tap_clubspeed.discover import discover_streams
+from tap_clubspeed.transform import RecordTransformer
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_server.py')
+
+
+class Stats(object):
+    def __init__(self):
+        self.current = None
+        self.streams = collections.OrderedDict()
+
+    def for_stream(self):
+        return self.streams.setdefault(self.current, collections.Counter())
+
+    def timed(self, category, func):
+        """ Wraps `func` so its CPU time is added to `category` of the current stream. """
+        def wrapper(*args, **kwargs):
+            started = time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.for_stream()[category] += time.process_time() - started
+        return wrapper
+
+
+@contextlib.contextmanager
+def fake_server(rows):
+    process = subprocess.Popen([sys.executable, FAKE_SERVER, '--rows', str(rows)],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        yield process.stdout.readline().strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(base_url, config, stream_names):
+    stats = Stats()
+    client = Clubspeed('bench', 'bench', base_url=base_url, **get_client_options(config))
+    catalog = Catalog.from_dict({'streams': discover_streams(client)})
+    for stream in catalog.streams:
+        if not stream_names or stream.tap_stream_id in stream_names:
+            stream.metadata[0]['metadata']['selected'] = True
+
+    sync_catalog_stream = tap_clubspeed.sync_catalog_stream
+    write_record = tap_clubspeed.sync.write_record
+
+    def timed_sync_catalog_stream(client, stream, *args):
+        stats.current = stream.tap_stream_id
+        started = time.time()
+        sync_catalog_stream(client, stream, *args)
+        stream_stats = stats.for_stream()
+        stream_stats['seconds'] += time.time() - started
+        stream_stats['peak_rss_mb'] = peak_rss_mb()
+
+    def counted_write_record(stream_name, record):
+        stats.for_stream()['rows'] += 1
+        write_record(stream_name, record)
+
+    def counted_request(*args, **kwargs):
+        stats.for_stream()['requests'] += 1
+        return request(*args, **kwargs)
+
+    request = client._request
+    client._request = counted_request
+    client._get_page = stats.timed('cpu_http', client._get_page)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+         mock.patch('tap_clubspeed.sync_catalog_stream', timed_sync_catalog_stream), \
+         mock.patch('tap_clubspeed.sync.write_record', stats.timed('cpu_output', counted_write_record)), \
+         mock.patch.object(RecordTransformer, 'transform', stats.timed('cpu_transform', RecordTransformer.transform)):
+        do_sync(client, catalog, {}, config)
+    client.close()
+    return stats.streams
+
+
+def report(results):
+    header = '{:<26} {:>8} {:>11} {:>8} {:>9} {:>9} {:>9} {:>9}'
+    print(header.format('stream', 'rows', 'rows/sec', 'requests', 'http cpu', 'xform cpu', 'out cpu', 'rss MB'))
+    for name, result in results.items():
+        print('{:<26} {:>8} {:>11,.0f} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.1f}'.format(
+            name, result['rows'], result['rows_per_sec'], result['requests'],
+            result['cpu_http'], result['cpu_transform'], result['cpu_output'], result['peak_rss_mb']))
+
+
+def regressions(results, baseline, max_regression):
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name, {}).get('rows_per_sec')
+        if expected and result['rows_per_sec'] < expected * (1 - max_regression):
+            failures.append('{}: {:,.0f} rows/sec vs. baseline {:,.0f}'.format(name, result['rows_per_sec'], expected))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000, help='rows served per endpoint')
+    parser.add_argument('--config', help='tap config JSON with client/sync options to benchmark')
+    parser.add_argument('--streams', nargs='*', help='streams to sync (default: all)')
+    parser.add_argument('--save', help='write results as JSON to this path')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed fractional drop in rows/sec against the baseline')
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    logging.disable(logging.INFO)
+    with fake_server(args.rows) as base_url:
+        streams = run(base_url, config, args.streams)
+
+    results = collections.OrderedDict()
+    for name, stream_stats in streams.items():
+        if name is None:
+            continue
+        result = {key: stream_stats[key] for key in
+                  ['rows', 'seconds', 'requests', 'cpu_http', 'cpu_transform', 'cpu_output', 'peak_rss_mb']}
+        result['rows_per_sec'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+        results[name] = result
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = regressions(results, json.load(f), args.max_regression)
+        if failures:
+            print('\nThroughput regressions:\n  ' + '\n  '.join(failures))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for a Clubspeed tenant, serving synthetic rows for every
+schema in `tap_clubspeed/schemas/` with the API's paging and response shapes.
+
+    $ python3 benchmarks/fake_server.py --rows 5000
+    http://127.0.0.1:53012/api/index.php/
+
+The first line written to stdout is the `base_url` to configure the tap with.
+"""
+import argparse
+import datetime
+import json
+import os
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tap_clubspeed', 'schemas')
+API_PREFIX = '/api/index.php/'
+
+# API path -> (schema that describes its rows, key the rows are wrapped in)
+ENDPOINTS = {
+    'booking': ('booking', 'bookings'),
+    'bookingAvailability': ('booking_availability', 'bookings'),
+    'checkDetails': ('check_details', 'checkDetails'),
+    'checks': ('checks', 'checks'),
+    'customers': ('customers', None),
+    'discountType': ('discount_types', None),
+    'eventHeatDetails': ('event_heat_details', None),
+    'eventHeatTypes': ('event_heat_types', None),
+    'eventReservationLinks': ('event_reservation_links', None),
+    'eventReservations': ('event_reservations', None),
+    'eventReservationTypes': ('event_reservation_types', None),
+    'eventRounds': ('event_rounds', None),
+    'events': ('events', None),
+    'eventStatuses': ('event_statuses', None),
+    'eventTasks': ('event_tasks', None),
+    'eventTaskTypes': ('event_task_types', None),
+    'eventTypes': ('event_types', None),
+    'giftCardHistory': ('gift_card_history', None),
+    'heatDetails': ('heat_main_details', None),
+    'heatMain': ('heat_main', None),
+    'heatTypes': ('heat_types', None),
+    'memberships': ('memberships', None),
+    'membershipTypes': ('membership_types', None),
+    'payments': ('payments', None),
+    'productClasses': ('product_classes', None),
+    'products': ('products', 'products'),
+    'reservations': ('reservations', 'reservations'),
+    'sources': ('sources', None),
+    'taxes': ('taxes', 'taxes'),
+    'users': ('users', None)
+}
+
+EPOCH = datetime.datetime(2018, 1, 1)
+
+
+def synthetic_value(field_schema, index):
+    types = field_schema.get('type', [])
+    types = types if isinstance(types, list) else [types]
+    if field_schema.get('format') == 'date-time':
+        return (EPOCH + datetime.timedelta(minutes=index)).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    if 'integer' in types:
+        return index
+    if 'number' in types:
+        return index * 1.25
+    if 'boolean' in types:
+        return index % 2 == 0
+    if 'array' in types:
+        return []
+    return 'value-{index}'.format(index=index)
+
+
+def synthetic_rows(schema_name, rows):
+    """ `rows` rows for the schema; timestamps ascend so bookmarks advance. """
+    with open(os.path.join(SCHEMAS_DIR, schema_name + '.json')) as f:
+        properties = json.load(f)['properties']
+    return [{name: synthetic_value(field, index) for name, field in properties.items()}
+            for index in range(rows)]
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(tables):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self): # pylint: disable=invalid-name
+            url = urlparse(self.path)
+            path = url.path[len(API_PREFIX):-len('.json')]
+            if not url.path.startswith(API_PREFIX) or path not in ENDPOINTS:
+                self.respond(404, {'error': 'not found'})
+                return
+            query = parse_qs(url.query)
+            limit = int(query.get('limit', ['100'])[0])
+            page = int(query.get('page', ['0'])[0])
+            rows = tables[path]
+            where = json.loads(query.get('where', ['{}'])[0])
+            if '$or' in where:
+                # heat_main_details asks for the details of a batch of heats.
+                heat_ids = set(condition['heatId'] for condition in where['$or'])
+                rows = [row for row in rows if row['heatId'] in heat_ids]
+            rows = rows[page * limit:(page + 1) * limit]
+            key = ENDPOINTS[path][1]
+            self.respond(200, {key: rows} if key else rows)
+
+        def respond(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args): # pylint: disable=arguments-differ
+            pass
+
+    return Handler
+
+
+def make_server(rows, port=0):
+    tables = {path: synthetic_rows(schema, rows) for path, (schema, _) in ENDPOINTS.items()}
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(tables))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000, help='rows served per endpoint')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    server = make_server(args.rows, args.port)
+    sys.stdout.write('http://127.0.0.1:{port}{prefix}\n'.format(port=server.server_address[1], prefix=API_PREFIX))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,9 @@ setup(name='tap-clubspeed',
           'singer-python==5.1.5',
           'requests==2.20.0'
       ],
+      extras_require={
+          'async': ['aiohttp>=3.5,<4']
+      },
       entry_points='''
           [console_scripts]
           tap-clubspeed=tap_clubspeed:main
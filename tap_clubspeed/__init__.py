@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
+import collections
+import datetime
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import singer
 from singer import metadata
 from tap_clubspeed.clubspeed import Clubspeed
 from tap_clubspeed.discover import discover_streams
-from tap_clubspeed.sync import sync_stream
-from tap_clubspeed.streams import STREAMS
+from tap_clubspeed.pipeline import DEFAULT_PIPELINE_QUEUE_SIZE
+from tap_clubspeed.run_metrics import export_metrics
+from tap_clubspeed.sync import (sync_stream, write_schema, write_state, configure_output, OUTPUT,
+                                StateEmitter, StateFlushPolicy)
+from tap_clubspeed.streams import STREAMS, TENANT_FIELD, SyncOptions
+from tap_clubspeed.timestamps import UTC
 
 LOGGER = singer.get_logger()
 
@@ -15,6 +22,42 @@ REQUIRED_CONFIG_KEYS = [
     "private_key"
 ]
 
+CLIENT_CONFIG_KEYS = [
+    "pool_size",
+    "connect_timeout",
+    "read_timeout",
+    "prefetch_pages",
+    "page_size",
+    "page_sizes",
+    "adaptive_page_size",
+    "min_page_size",
+    "max_page_size",
+    "page_latency_budget",
+    "page_bytes_budget",
+    "stream_json",
+    "cassette_mode",
+    "cassette_path",
+    "replay_latency",
+    "base_url",
+    "heat_batch_size",
+    "max_url_length",
+    "heat_detail_workers",
+    "heat_details_ordered",
+    "max_retries",
+    "backoff_factor",
+    "max_backoff",
+    "max_requests",
+    "max_retry_seconds",
+    "circuit_breaker_threshold",
+    "circuit_breaker_cooldown",
+    "skip_failed_pages",
+    "requests_per_second",
+    "rate_limit_burst",
+    "max_in_flight",
+    "min_requests_per_second",
+    "project_fields"
+]
+
 
 def do_discover(client):
     LOGGER.info("Starting discover")
@@ -40,56 +83,210 @@ class DependencyException(Exception):
     pass
 
 
-def populate_class_schemas(catalog, selected_stream_names):
-    for stream in catalog.streams:
-        if stream.tap_stream_id in selected_stream_names:
-            STREAMS[stream.tap_stream_id].stream = stream
-
-
 def ensure_credentials_are_authorized(client):
     client.is_authorized()
 
 
-def do_sync(client, catalog, state):
+def get_client_options(config):
+    return {key: config[key] for key in CLIENT_CONFIG_KEYS if key in config}
+
+
+def sync_catalog_stream(client, stream, state, emitter, flush_policy, pipeline_queue_size=0, tenant=None,
+                        selected_streams=(), options=None):
+    stream_name = stream.tap_stream_id
+    mdata = metadata.to_map(stream.metadata)
+
+    key_properties = metadata.get(mdata, (), 'table-key-properties')
+    schema = stream.schema.to_dict()
+    if tenant is not None:
+        schema['properties'][TENANT_FIELD] = {'type': ['string']}
+        key_properties = [TENANT_FIELD] + list(key_properties or [])
+    write_schema(stream_name, schema, key_properties)
+
+    LOGGER.info("%s: Starting sync", stream_name)
+    instance = STREAMS[stream_name](client)
+    instance.stream = stream
+    instance.tenant = tenant
+    instance.selected_streams = frozenset(selected_streams)
+    instance.options = options or SyncOptions()
+    counter_value = sync_stream(state, instance, emitter, flush_policy, pipeline_queue_size)
+    LOGGER.info("%s: Completed sync (%s rows)", stream_name, counter_value)
+
+
+# Runs independent streams on a worker pool. A stream is only started once
+# every selected stream in its `depends_on` has completed.
+def sync_streams_concurrently(client, streams, emitter, flush_policy, max_workers, pipeline_queue_size=0,
+                              tenant=None, options=None):
+    pending = collections.OrderedDict((s.tap_stream_id, s) for s in streams)
+    selected = set(pending)
+    completed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stream_name in list(pending):
+                dependencies = set(STREAMS[stream_name].depends_on) & selected
+                if dependencies <= completed:
+                    stream = pending.pop(stream_name)
+                    future = executor.submit(sync_catalog_stream, client, stream, emitter.snapshot(), emitter,
+                                             flush_policy, pipeline_queue_size, tenant, selected, options)
+                    running[future] = stream_name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                completed.add(running.pop(future))
+                future.result()
+
+
+# Syncs the selected streams of one tenant. With `tenant` set, its state is
+# part of a larger one that other tenants write to at the same time, so each
+# stream works on a copy merged back by the emitter.
+def sync_tenant(client, catalog, state, config, emitter=None, tenant=None, options=None):
     ensure_credentials_are_authorized(client)
     selected_stream_names = get_selected_streams(catalog)
-    populate_class_schemas(catalog, selected_stream_names)
+    emitter = emitter or StateEmitter(state)
+    flush_policy = StateFlushPolicy.from_config(config)
+    options = options or SyncOptions.from_config(config)
 
+    streams = []
     for stream in catalog.streams:
-        stream_name = stream.tap_stream_id
+        if stream.tap_stream_id not in selected_stream_names:
+            LOGGER.info("%s: Skipping - not selected", stream.tap_stream_id)
+            continue
+        streams.append(stream)
 
-        mdata = metadata.to_map(stream.metadata)
+    max_workers = int(config.get('max_stream_workers', 1))
+    pipeline_queue_size = 0
+    if config.get('pipeline'):
+        pipeline_queue_size = int(config.get('pipeline_queue_size', DEFAULT_PIPELINE_QUEUE_SIZE))
+    if max_workers > 1:
+        sync_streams_concurrently(client, streams, emitter, flush_policy, max_workers, pipeline_queue_size, tenant,
+                                  options)
+    else:
+        for stream in streams:
+            stream_state = state if tenant is None else emitter.snapshot()
+            sync_catalog_stream(client, stream, stream_state, emitter, flush_policy, pipeline_queue_size, tenant,
+                                selected_stream_names, options)
 
-        if stream_name not in selected_stream_names:
-            LOGGER.info("%s: Skipping - not selected", stream_name)
-            continue
 
-        key_properties = metadata.get(mdata, (), 'table-key-properties')
-        singer.write_schema(stream_name, stream.schema.to_dict(), key_properties)
+def log_connection_stats(client, tenant=None):
+    prefix = "{}: ".format(tenant) if tenant is not None else ""
+    stats = client.connection_stats()
+    LOGGER.info("%sHTTP connections: %s opened, %s reused across %s requests",
+                prefix, stats['connections_opened'], stats['connections_reused'], stats['requests'])
+    LOGGER.info("%sHTTP retries: %s, pages skipped: %s", prefix, stats['retries'], stats['skipped_pages'])
+    LOGGER.info("%sRate limit: %s requests/sec, %.1fs spent queued",
+                prefix, stats['request_rate'] or 'unlimited', stats['rate_limit_wait_seconds'])
 
-        LOGGER.info("%s: Starting sync", stream_name)
-        instance = STREAMS[stream_name](client)
-        instance.stream = stream
-        counter_value = sync_stream(state, instance)
-        singer.write_state(state)
-        LOGGER.info("%s: Completed sync (%s rows)", stream_name, counter_value)
 
-    singer.write_state(state)
+def do_sync(client, catalog, state, config=None):
+    config = config or {}
+    options = SyncOptions.from_config(config, datetime.datetime.now(UTC))
+    configure_output(config)
+    try:
+        with export_metrics(config):
+            sync_tenant(client, catalog, state, config, options=options)
+            write_state(state)
+    finally:
+        OUTPUT.close()
+
+    log_connection_stats(client)
     LOGGER.info("Finished sync")
 
 
-@singer.utils.handle_top_exception(LOGGER)
-def main():
-    parsed_args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
+# Syncs several tenants in one process, `max_tenant_workers` at a time, each
+# through its own client and connection pool. `tenants` holds a (name,
+# config, client) per tenant; each tenant's config decides how its streams
+# sync, while output and metrics follow the top-level `config`. Every tenant
+# keeps its state under `tenants.<name>` and its records are tagged with
+# `_sdc_tenant`. A failed tenant doesn't stop the others; the first error is
+# raised once they have finished.
+def do_sync_tenants(tenants, catalog, state, config=None):
+    config = config or {}
+    sync_started = datetime.datetime.now(UTC)
+    options = {name: SyncOptions.from_config(tenant_config, sync_started) for name, tenant_config, _ in tenants}
+    tenant_states = state.setdefault('tenants', {})
+    errors = []
+
+    def sync_one(tenant, tenant_config, client):
+        tenant_state = tenant_states[tenant]
+        try:
+            sync_tenant(client, catalog, tenant_state, tenant_config, StateEmitter(tenant_state, root=state), tenant,
+                        options[tenant])
+        except Exception as e:
+            LOGGER.error("%s: Sync failed: %s", tenant, e)
+            errors.append(e)
+
+    # Added up front: the state is written out while tenants sync.
+    for tenant, _, _ in tenants:
+        tenant_states.setdefault(tenant, {})
+    configure_output(config)
+    try:
+        with export_metrics(config), \
+             ThreadPoolExecutor(max_workers=int(config.get('max_tenant_workers', 1))) as executor:
+            for tenant, tenant_config, client in tenants:
+                executor.submit(sync_one, tenant, tenant_config, client)
+        write_state(state)
+    finally:
+        OUTPUT.close()
+
+    for tenant, _, client in tenants:
+        log_connection_stats(client, tenant)
+    if errors:
+        raise errors[0]
+    LOGGER.info("Finished sync of %s tenants", len(tenants))
 
+
+# One (name, config) per tenant: each entry of `tenants` laid over the
+# shared top-level options, or the config itself (named None) without them.
+def get_tenant_configs(config):
+    tenants = config.get('tenants')
+    if not tenants:
+        singer.utils.check_config(config, REQUIRED_CONFIG_KEYS)
+        return [(None, config)]
+
+    tenant_configs = []
+    for tenant in tenants:
+        tenant_config = dict(config, **tenant)
+        del tenant_config['tenants']
+        singer.utils.check_config(tenant_config, REQUIRED_CONFIG_KEYS)
+        name = tenant.get('name', tenant_config['subdomain'])
+        if name in (n for n, _ in tenant_configs):
+            raise Exception("Tenant {name} is listed twice.".format(name=name))
+        tenant_configs.append((name, tenant_config))
+    return tenant_configs
+
+
+def create_client(config, tenant=None):
     creds = {
-        "subdomain": parsed_args.config['subdomain'],
-        "private_key": parsed_args.config['private_key']
+        "subdomain": config['subdomain'],
+        "private_key": config['private_key'],
+        "tenant": tenant
     }
-    client = Clubspeed(**creds)
+    creds.update(get_client_options(config))
+    if config.get('async_client'):
+        # Only imported when asked for, to keep startup light.
+        from tap_clubspeed.async_client import AsyncClubspeed, BlockingClient
+        return BlockingClient(AsyncClubspeed(**creds))
+    return Clubspeed(**creds)
+
+
+@singer.utils.handle_top_exception(LOGGER)
+def main():
+    # Credentials are checked per tenant by `get_tenant_configs`.
+    parsed_args = singer.utils.parse_args([])
+    tenant_configs = get_tenant_configs(parsed_args.config)
+    tenants = [(name, tenant_config, create_client(tenant_config, name)) for name, tenant_config in tenant_configs]
 
-    if parsed_args.discover:
-        do_discover(client)
-    elif parsed_args.catalog:
-        state = parsed_args.state or {}
-        do_sync(client, parsed_args.catalog, state)
+    try:
+        if parsed_args.discover:
+            do_discover(tenants[0][2])
+        elif parsed_args.catalog:
+            state = parsed_args.state or {}
+            if parsed_args.config.get('tenants'):
+                do_sync_tenants(tenants, parsed_args.catalog, state, parsed_args.config)
+            else:
+                do_sync(tenants[0][2], parsed_args.catalog, state, parsed_args.config)
+    finally:
+        for _, _, client in tenants:
+            client.close()
@@ -0,0 +1,394 @@
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+
+import requests
+
+from tap_clubspeed.clubspeed import Clubspeed, IgnoreHttpException, PageSize, END_OF_PAGE, DEFAULT_POOL_SIZE
+from tap_clubspeed.retry import RETRY_STATUSES, THROTTLE_STATUSES, CircuitOpenError
+from tap_clubspeed.run_metrics import RUN_METRICS
+
+logger = logging.getLogger()
+
+
+def import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError('The async client needs aiohttp: pip install "tap-clubspeed[async]"')
+    return aiohttp
+
+
+def retry_errors():
+    """ Exceptions from the HTTP layer that are worth retrying. """
+    try:
+        import aiohttp
+    except ImportError:
+        return (asyncio.TimeoutError, OSError)
+    return (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class HttpResponse(object):
+    """ A response read in full, shaped like the parts of `requests.Response`
+    the client uses. """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+    def close(self):
+        pass
+
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('{status} Error for url: {url}'.format(status=self.status_code,
+                                                                                      url=self.url), response=self)
+
+
+class AsyncPagedResponse(object):
+    """ Pages through one endpoint on the event loop, keeping up to `window`
+    page requests in flight ahead of the consumer. Rows are read with
+    `async for`, or a page at a time with `next_page`. As with prefetched
+    pages in the blocking client, the limit is fixed and a short page ends the
+    table. """
+
+    def __init__(self, client, spec, key=None, page_size=None, window=1):
+        self._client = client
+        self._spec = spec
+        self._key = key
+        self._page_size = page_size or PageSize(client._limit)
+        self._limit = self._page_size.limit
+        self._window = max(int(window), 1)
+        self._in_flight = collections.deque()
+        self._next_page = self._page_size.offset // self._limit
+        self._exhausted = False
+        self._rows = iter(())
+        self._next_row = END_OF_PAGE
+        self.page_complete = False
+        self.position = None
+
+
+    def start(self):
+        """ Sends the first requests without waiting for them. """
+        while len(self._in_flight) < self._window and not self._exhausted:
+            request = self._client._get_page(self._spec, self._next_page, self._key, self._limit)
+            self._in_flight.append((self._next_page, asyncio.ensure_future(request)))
+            self._next_page += 1
+
+
+    async def next_page(self):
+        """ The rows of the next page and its (offset, limit), or None once
+        the table is exhausted. """
+        while True:
+            self.start()
+            if not self._in_flight:
+                return None
+            page, request = self._in_flight.popleft()
+            rows = await request
+            if rows is None:
+                self._client._skip_page(self._spec, page)
+                continue
+            if len(rows) < self._limit:
+                self.close()
+            if not rows:
+                return None
+            self._page_size.offset = page * self._limit
+            return rows, (self._page_size.offset, self._limit)
+
+
+    def close(self):
+        self._exhausted = True
+        for _, request in self._in_flight:
+            request.cancel()
+        self._in_flight.clear()
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        while self._next_row is END_OF_PAGE:
+            page = await self.next_page()
+            if page is None:
+                raise StopAsyncIteration
+            rows, self.position = page
+            self._rows = iter(rows)
+            self._next_row = next(self._rows, END_OF_PAGE)
+        row = self._next_row
+        self._next_row = next(self._rows, END_OF_PAGE)
+        self.page_complete = self._next_row is END_OF_PAGE
+        return row
+
+
+class AsyncChainedResponse(AsyncPagedResponse):
+    """ The pages of several responses one after the other, with the next
+    `workers` responses already started so their first pages are in flight. """
+
+    def __init__(self, responses, workers=1): # pylint: disable=super-init-not-called
+        self._responses = iter(responses)
+        self._workers = max(int(workers), 1)
+        self._started = collections.deque()
+        self._rows = iter(())
+        self._next_row = END_OF_PAGE
+        self.page_complete = False
+        self.position = None
+
+
+    def start(self):
+        while len(self._started) < self._workers:
+            response = next(self._responses, None)
+            if response is None:
+                return
+            response.start()
+            self._started.append(response)
+
+
+    async def next_page(self):
+        while True:
+            self.start()
+            if not self._started:
+                return None
+            page = await self._started[0].next_page()
+            if page is not None:
+                return page
+            self._started.popleft()
+
+
+    def close(self):
+        for response in self._started:
+            response.close()
+        self._started.clear()
+        self._responses = iter(())
+
+
+class AsyncClubspeed(Clubspeed):
+    """ The Clubspeed client on asyncio and aiohttp. Every stream method
+    returns an AsyncPagedResponse, so one event loop drives the page and
+    stream fetches of a whole sync over a shared pool of `pool_size`
+    connections. Use it from a coroutine on that loop, or from blocking code
+    through `BlockingClient`. """
+
+    def __init__(self, *args, **kwargs):
+        self._pool_size = DEFAULT_POOL_SIZE
+        self._slots = None
+        super().__init__(*args, **kwargs)
+        for option in ('adaptive_page_size', 'stream_json'):
+            if getattr(self, '_' + option):
+                raise ValueError('The async client does not support {option}.'.format(option=option))
+
+
+    def _create_session(self, pool_size, cassette_mode=None, cassette_path=None, replay_latency=0):
+        if cassette_mode is not None:
+            raise ValueError('The async client does not support cassettes.')
+        # The aiohttp session has to be created on the event loop it runs on.
+        self._pool_size = pool_size
+        return None
+
+
+    async def _get_session(self):
+        if self.session is None:
+            aiohttp = import_aiohttp()
+            connect_timeout, read_timeout = self.timeout
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+                headers={'Accept-Encoding': 'gzip, deflate'})
+        return self.session
+
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+    async def _acquire_rate_limit(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.rate_limiter.max_in_flight or self._pool_size)
+        started = time.monotonic()
+        await self._slots.acquire()
+        try:
+            if self.rate_limiter.rate:
+                delay = self.rate_limiter.take_token()
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self.rate_limiter.take_token()
+        except BaseException:
+            # Cancelled while waiting for a token, e.g. a page prefetched
+            # past the end of a table; `_send` never gets to release it.
+            self._slots.release()
+            raise
+        self.rate_limiter.record_wait(time.monotonic() - started)
+
+
+    async def _send(self, session, url, endpoint=None):
+        await self._acquire_rate_limit()
+        response = None
+        started = time.time()
+        try:
+            async with session.get(url) as res:
+                response = HttpResponse(url, res.status, res.headers, await res.read())
+            return response
+        finally:
+            RUN_METRICS.observe_request(endpoint, self.tenant, time.time() - started)
+            self._slots.release()
+            self.rate_limiter.adapt(throttled=response is not None and response.status_code in THROTTLE_STATUSES)
+
+
+    # The same retry, budget and circuit breaker rules as the blocking
+    # client, waiting on the event loop instead of sleeping.
+    async def _request(self, url, stream=False, endpoint=None):
+        session = await self._get_session()
+        errors = retry_errors()
+        attempt = 0
+        while True:
+            self._retry.start_request()
+            self._breaker.before_request()
+            logger.info("Hitting endpoint {url}".format(url=url))
+            with self._stats_lock:
+                self._request_count += 1
+            response, error = None, None
+            try:
+                response = await self._send(session, url, endpoint)
+            except errors as e:
+                error = e
+            if error is None and response.status_code not in RETRY_STATUSES:
+                self._breaker.record_success()
+                response.raise_for_status()
+                return response
+
+            if self._breaker.record_failure():
+                raise CircuitOpenError('Circuit opened after {failures} consecutive failed requests to {url}.'.format(
+                    failures=self._breaker.failures, url=url))
+            delay = self._retry.backoff(attempt, response)
+            if not self._retry.reserve_wait(attempt, delay):
+                break
+            reason = error or 'HTTP {status}'.format(status=response.status_code)
+            logger.warning('Retrying {url} in {delay:.1f}s after {reason}.'.format(url=url, delay=delay, reason=reason))
+            self._count('retries', 'http_retries', endpoint)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        if error is not None:
+            raise error
+        if response.status_code == 500:
+            raise IgnoreHttpException("http status is 500.")
+        response.raise_for_status()
+        return response
+
+
+    async def _get(self, url, **kwargs):
+        response = await self._request(url)
+        return response.json()
+
+
+    async def _get_page(self, spec, page, key=None, limit=None, stream=False):
+        try:
+            response = await self._request(spec.url(page, limit or self._limit), endpoint=spec.path)
+        except IgnoreHttpException:
+            if not self._skip_failed_pages:
+                raise
+            logger.info('Encountered 500, will ignore.')
+            return None
+        res = response.json()
+        res = res[key] if key is not None else res
+        if spec.fields:
+            res = [spec.prune(row) for row in res]
+        logger.info('Endpoint returned {length} rows.'.format(length=len(res)))
+        RUN_METRICS.observe_page(spec.path, self.tenant, len(res), len(response.content))
+        return res
+
+
+    def _get_response(self, spec, key=None, page_size=None):
+        return AsyncPagedResponse(self, spec, key, page_size, self._prefetch_pages)
+
+
+    # Batches are read in heat order, with the next `_heat_detail_workers`
+    # batches' first pages already in flight.
+    def heat_main_details(self, column_name=None, bookmark=None, page_size=None, heat_ids=(), fields=None):
+        responses = (self._get_response(spec, page_size=page_size.fresh() if page_size else None)
+                     for spec in self._heat_details_specs(heat_ids, fields))
+        return AsyncChainedResponse(responses, self._heat_detail_workers)
+
+
+class BlockingResponse(object):
+    """ Iterates an async response from blocking code, fetching it from the
+    event loop a page at a time. """
+
+    def __init__(self, client, response):
+        self._client = client
+        self._response = response
+        self._rows = iter(())
+        self._next_row = END_OF_PAGE
+        self.page_complete = False
+        self.position = None
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        while self._next_row is END_OF_PAGE:
+            page = self._client.run(self._response.next_page())
+            if page is None:
+                raise StopIteration
+            rows, self.position = page
+            self._rows = iter(rows)
+            self._next_row = next(self._rows, END_OF_PAGE)
+        row = self._next_row
+        self._next_row = next(self._rows, END_OF_PAGE)
+        self.page_complete = self._next_row is END_OF_PAGE
+        return row
+
+
+class BlockingClient(object):
+    """ Lets blocking code such as `do_sync` use an AsyncClubspeed. The
+    client's event loop runs on a thread of its own; stream methods return
+    iterators over it and coroutines are run to completion. Streams synced on
+    several threads share the one loop and connection pool. """
+
+    def __init__(self, client):
+        self.client = client
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='clubspeed-async', daemon=True)
+        self._thread.start()
+
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                return self.run(result)
+            if isinstance(result, AsyncPagedResponse):
+                return BlockingResponse(self, result)
+            return result
+        return call
+
+
+    def close(self):
+        try:
+            self.run(self.client.close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
@@ -0,0 +1,99 @@
+import collections
+import gzip
+import json
+import re
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# The private key is never written to a cassette.
+KEY_PARAM = re.compile(r'([?&]key=)[^&]*')
+SCRUBBED_KEY = r'\1REDACTED'
+RECORDED_HEADERS = ['Content-Type', 'Retry-After']
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+def scrub_url(url):
+    return KEY_PARAM.sub(SCRUBBED_KEY, url)
+
+
+def load_cassette(path):
+    """ Recorded responses by scrubbed URL, in the order they were recorded. """
+    interactions = collections.defaultdict(collections.deque)
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            interaction = json.loads(line)
+            interactions[interaction['url']].append(interaction)
+    return interactions
+
+
+def build_response(interaction, url):
+    response = requests.Response()
+    response.status_code = interaction['status']
+    response.reason = interaction.get('reason', '')
+    response.headers = CaseInsensitiveDict(interaction.get('headers', {}))
+    response.encoding = 'utf-8'
+    response.url = url
+    response._content = interaction['body'].encode('utf-8') # pylint: disable=protected-access
+    response._content_consumed = True # pylint: disable=protected-access
+    return response
+
+
+class RecordingSession(requests.Session):
+    """ A session that appends every request/response pair it makes to a
+    gzipped JSON-lines cassette at `path`. """
+
+    def __init__(self, path):
+        super().__init__()
+        self._cassette = gzip.open(path, 'wt', encoding='utf-8')
+        self._lock = threading.Lock()
+
+
+    def request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        interaction = {
+            'url': scrub_url(url),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {h: response.headers[h] for h in RECORDED_HEADERS if h in response.headers},
+            'body': response.content.decode('utf-8', 'replace')
+        }
+        with self._lock:
+            self._cassette.write(json.dumps(interaction, separators=(',', ':')) + '\n')
+        return response
+
+
+    def close(self):
+        with self._lock:
+            self._cassette.close()
+        super().close()
+
+
+class ReplaySession(requests.Session):
+    """ A session that serves responses from a cassette instead of the
+    network, waiting `latency` seconds per request to stand in for the round
+    trip. Repeated requests for a URL get its recordings in order, then the
+    last one again. """
+
+    def __init__(self, path, latency=0):
+        super().__init__()
+        self._interactions = load_cassette(path)
+        self._latency = float(latency)
+        self._lock = threading.Lock()
+
+
+    def request(self, method, url, *args, **kwargs):
+        scrubbed = scrub_url(url)
+        with self._lock:
+            recorded = self._interactions.get(scrubbed)
+            if not recorded:
+                raise CassetteMissError('No recorded response for {url}'.format(url=scrubbed))
+            interaction = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        if self._latency:
+            time.sleep(self._latency)
+        return build_response(interaction, url)
@@ -1,317 +1,782 @@
 
-import requests
+import collections
+import copy
+import functools
+import json
+import threading
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+import singer.metrics as metrics
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode, quote
+from tap_clubspeed.json_stream import RowStream
+from tap_clubspeed.cassette import RecordingSession, ReplaySession
+from tap_clubspeed.rate_limit import RateLimiter, DEFAULT_MIN_REQUESTS_PER_SECOND
+from tap_clubspeed.retry import (RetryPolicy, CircuitBreaker, CircuitOpenError, RETRY_STATUSES, THROTTLE_STATUSES,
+                                 DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF_FACTOR, DEFAULT_MAX_BACKOFF,
+                                 DEFAULT_MAX_RETRY_SECONDS, DEFAULT_CIRCUIT_BREAKER_THRESHOLD,
+                                 DEFAULT_CIRCUIT_BREAKER_COOLDOWN)
+from tap_clubspeed.run_metrics import RUN_METRICS
 
 logger = logging.getLogger()
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MIN_PAGE_SIZE = 25
+DEFAULT_MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_LATENCY_BUDGET = 10
+DEFAULT_PAGE_BYTES_BUDGET = 5 * 1024 * 1024
+DEFAULT_HEAT_BATCH_SIZE = 30
+DEFAULT_MAX_URL_LENGTH = 2000
+# Room left in a URL for `&page=...&limit=...`.
+PAGE_PARAMS_LENGTH = 32
+
+
+END_OF_PAGE = object()
+
 
 class IgnoreHttpException(Exception):
     pass
 
 
+class PagedResponse(object):
+    """ Iterates the rows of a paginated endpoint, remembering which page the
+    last row came from and whether it was the final row of that page. Pages
+    may be lists or row iterators; one row is read ahead to spot the end.
+    `position` is the (offset, limit) of that page, taken from `page_size`. """
+
+    def __init__(self, pages, page_size=None):
+        self._pages = pages
+        self._page_size = page_size
+        self._rows = iter(())
+        self._next_row = END_OF_PAGE
+        self.page = None
+        self.page_complete = False
+        self.position = None
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        while self._next_row is END_OF_PAGE:
+            self.page, rows = next(self._pages)
+            if self._page_size is not None:
+                self.position = (self._page_size.offset, self._page_size.limit)
+            self._rows = iter(rows)
+            self._next_row = next(self._rows, END_OF_PAGE)
+        row = self._next_row
+        self._next_row = next(self._rows, END_OF_PAGE)
+        self.page_complete = self._next_row is END_OF_PAGE
+        return row
+
+
+class PageSize(object):
+    """ The `limit` used to page through one endpoint.
+
+    When adaptive, the limit doubles while pages come back well inside the
+    latency and payload budgets, and halves when a page is slow, too large or
+    fails. A new limit is only taken once it divides the current row offset.
+
+    `offset` is the row offset of the page being read, and where paging
+    starts when resuming from a checkpoint. """
+
+    def __init__(self, limit=DEFAULT_PAGE_SIZE, adaptive=False,
+                 min_limit=DEFAULT_MIN_PAGE_SIZE, max_limit=DEFAULT_MAX_PAGE_SIZE,
+                 latency_budget=DEFAULT_PAGE_LATENCY_BUDGET, bytes_budget=DEFAULT_PAGE_BYTES_BUDGET):
+        self.adaptive = adaptive
+        self.min_limit = int(min_limit)
+        self.max_limit = int(max_limit)
+        self.latency_budget = float(latency_budget)
+        self.bytes_budget = int(bytes_budget)
+        self.limit = int(limit)
+        if adaptive:
+            self.limit = min(max(self.limit, self.min_limit), self.max_limit)
+        self.offset = 0
+
+
+    def fresh(self):
+        """ The same limit and budgets, starting from the first page: for a
+        request of the stream other than the one this was paging through. """
+        page_size = copy.copy(self)
+        page_size.offset = 0
+        return page_size
+
+
+    def resume(self, page, limit):
+        """ Starts paging at `page` of `limit` rows. """
+        self.limit = int(limit)
+        self.offset = int(page) * self.limit
+
+
+    def update(self, offset, elapsed, size, failed=False):
+        if not self.adaptive:
+            return
+        if failed or elapsed > self.latency_budget or size > self.bytes_budget:
+            smaller = max(self.limit // 2, self.min_limit)
+            if smaller < self.limit and offset % smaller == 0:
+                logger.info('Shrinking page size to {limit}.'.format(limit=smaller))
+                self.limit = smaller
+        elif elapsed < self.latency_budget / 2 and size < self.bytes_budget / 2:
+            larger = min(self.limit * 2, self.max_limit)
+            if larger > self.limit and offset % larger == 0:
+                logger.info('Growing page size to {limit}.'.format(limit=larger))
+                self.limit = larger
+
+
+class RequestSpec(object):
+    """ One paginated API request: path, API version, filter, order and
+    selected columns. The encoded query string is built once; rendering a
+    page only appends the page and limit. Rows are cut down to `fields`, when
+    set, as pages are decoded. """
+
+    def __init__(self, base_url, path, private_key, api_version='V2'):
+        self.base_url = base_url
+        self.path = path
+        self.private_key = private_key
+        self.api_version = api_version
+        self.where = None
+        self.filter = None
+        self.order = None
+        self.select = None
+        self.fields = None
+        self._prefix = None
+
+
+    def add_filter(self, column_name, bookmark, until=None):
+        """ Only rows with `column_name` after `bookmark` (or not null) and,
+        given `until`, no later than it, in order. """
+        if column_name is None:
+            return self
+        if self.api_version == 'V2':
+            condition = {} if bookmark is None else {"$gt": bookmark}
+            if until is not None:
+                condition["$lte"] = until
+            self.where = {column_name: condition or {"$isnot": "null"}}
+        else:
+            if bookmark is None:
+                conditions = ['{column_name} IS NOT NULL'.format(column_name=column_name)]
+            else:
+                conditions = ['{column_name} > {bookmark}'.format(column_name=column_name, bookmark=bookmark)]
+            if until is not None:
+                conditions.append('{column_name} <= {until}'.format(column_name=column_name, until=until))
+            self.filter = ' AND '.join(conditions)
+        self.order = '{column_name} ASC'.format(column_name=column_name)
+        self._prefix = None
+        return self
+
+
+    def prune(self, row):
+        if self.fields is None:
+            return row
+        return {name: row[name] for name in self.fields if name in row}
+
+
+    def params(self):
+        params = [('key', self.private_key)]
+        if self.where is not None:
+            params.append(('where', json.dumps(self.where, separators=(',', ':'))))
+        if self.filter is not None:
+            params.append(('filter', self.filter))
+        if self.order is not None:
+            params.append(('order', self.order))
+        if self.select is not None:
+            params.append(('select', ','.join(self.select)))
+        return params
+
+
+    def url(self, page=None, limit=None):
+        if self._prefix is None:
+            self._prefix = '{base_url}{path}.json?{query}'.format(
+                base_url=self.base_url, path=self.path, query=urlencode(self.params(), quote_via=quote))
+        if page is None:
+            return self._prefix
+        return '{prefix}&page={page}&limit={limit}'.format(prefix=self._prefix, page=page, limit=limit)
+
+
 class Clubspeed(object):
 
 
-    def __init__(self, subdomain=None, private_key=None, session=None):
+    def __init__(self, subdomain=None, private_key=None, session=None,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 prefetch_pages=0,
+                 page_size=DEFAULT_PAGE_SIZE,
+                 page_sizes=None,
+                 adaptive_page_size=False,
+                 min_page_size=DEFAULT_MIN_PAGE_SIZE,
+                 max_page_size=DEFAULT_MAX_PAGE_SIZE,
+                 page_latency_budget=DEFAULT_PAGE_LATENCY_BUDGET,
+                 page_bytes_budget=DEFAULT_PAGE_BYTES_BUDGET,
+                 stream_json=False,
+                 cassette_mode=None,
+                 cassette_path=None,
+                 replay_latency=0,
+                 base_url=None,
+                 heat_batch_size=DEFAULT_HEAT_BATCH_SIZE,
+                 max_url_length=DEFAULT_MAX_URL_LENGTH,
+                 heat_detail_workers=1,
+                 heat_details_ordered=True,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 max_backoff=DEFAULT_MAX_BACKOFF,
+                 max_requests=None,
+                 max_retry_seconds=DEFAULT_MAX_RETRY_SECONDS,
+                 circuit_breaker_threshold=DEFAULT_CIRCUIT_BREAKER_THRESHOLD,
+                 circuit_breaker_cooldown=DEFAULT_CIRCUIT_BREAKER_COOLDOWN,
+                 skip_failed_pages=True,
+                 requests_per_second=None,
+                 rate_limit_burst=None,
+                 max_in_flight=None,
+                 min_requests_per_second=DEFAULT_MIN_REQUESTS_PER_SECOND,
+                 project_fields=False,
+                 tenant=None):
         """ Simple Python wrapper for the Clubspeed API. Only supports GET. """
         self.protocol = 'https'
         self.domain = 'clubspeedtiming.com'
         self.subdomain = subdomain
         self.api_prefix = 'api/index.php/'
         self.private_key = private_key
-        self._new_heats = []
-        self._url_template = "{protocol}://{subdomain}.{domain}/{api_prefix}{path}.json?key={private_key}"
-        self._limit = 100
+        self._base_url = base_url
+        self._limit = int(page_size)
+        self._page_sizes = {name: int(limit) for name, limit in (page_sizes or {}).items()}
+        self._adaptive_page_size = bool(adaptive_page_size)
+        self._page_size_bounds = {
+            'min_limit': min_page_size,
+            'max_limit': max_page_size,
+            'latency_budget': page_latency_budget,
+            'bytes_budget': page_bytes_budget
+        }
         self._test = False
-
-
-    def _get(self, url, **kwargs):
-        logger.info("Hitting endpoint {url}".format(url=url))
-        response = requests.get(url)
+        self.session = session or self._create_session(int(pool_size), cassette_mode, cassette_path, replay_latency)
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self._request_count = 0
+        self._stats_lock = threading.Lock()
+        self._prefetch_pages = int(prefetch_pages)
+        self._stream_json = bool(stream_json)
+        self._heat_batch_size = int(heat_batch_size)
+        self._max_url_length = int(max_url_length)
+        self._heat_detail_workers = int(heat_detail_workers)
+        self.heat_details_ordered = bool(heat_details_ordered)
+        self._retry = RetryPolicy(max_retries, backoff_factor, max_backoff, max_requests, max_retry_seconds)
+        self._breaker = CircuitBreaker(circuit_breaker_threshold, circuit_breaker_cooldown)
+        self._skip_failed_pages = bool(skip_failed_pages)
+        self._retries = 0
+        self._skipped_pages = 0
+        self.project_fields = bool(project_fields)
+        # Labels this client's requests in the run's metrics.
+        self.tenant = tenant
+        self.rate_limiter = RateLimiter(requests_per_second, rate_limit_burst, max_in_flight, min_requests_per_second)
+
+
+    def _create_session(self, pool_size, cassette_mode=None, cassette_path=None, replay_latency=0):
+        if cassette_mode == 'replay':
+            return ReplaySession(cassette_path, replay_latency)
+        # One keep-alive session is shared by every stream method, so pages
+        # after the first reuse an open connection instead of a new TLS handshake.
+        if cassette_mode == 'record':
+            session = RecordingSession(cassette_path)
+        elif cassette_mode is None:
+            session = requests.Session()
+        else:
+            raise ValueError('Unknown cassette_mode {mode!r}.'.format(mode=cassette_mode))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return session
+
+
+    def close(self):
+        self.session.close()
+
+
+    def connection_stats(self):
+        """ Connections opened vs. reused across all requests so far, with
+        the current request rate and time spent queued by the rate limiter. """
+        opened = 0
+        adapters = {id(a): a for a in getattr(self.session, 'adapters', {}).values()}
+        for adapter in adapters.values():
+            pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+            if pools is None:
+                continue
+            for pool_key in pools.keys():
+                opened += getattr(pools.get(pool_key), 'num_connections', 0)
+        rate_limit = self.rate_limiter.stats()
+        return {
+            'requests': self._request_count,
+            'connections_opened': opened,
+            'connections_reused': max(0, self._request_count - opened),
+            'retries': self._retries,
+            'skipped_pages': self._skipped_pages,
+            'request_rate': rate_limit['rate'],
+            'rate_limit_wait_seconds': rate_limit['wait_seconds']
+        }
+
+
+    # Rate limiting, server errors, timeouts and dropped connections are
+    # retried with backoff. A 500 that outlasts its retries raises
+    # IgnoreHttpException so the page can be skipped.
+    def _request(self, url, stream=False, endpoint=None):
+        attempt = 0
+        while True:
+            self._retry.start_request()
+            self._breaker.before_request()
+            logger.info("Hitting endpoint {url}".format(url=url))
+            with self._stats_lock:
+                self._request_count += 1
+            response, error = None, None
+            self.rate_limiter.acquire()
+            started = time.time()
+            try:
+                response = self.session.get(url, timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            finally:
+                RUN_METRICS.observe_request(endpoint, self.tenant, time.time() - started)
+                throttled = response is not None and response.status_code in THROTTLE_STATUSES
+                # A streamed body still holds its connection: the slot is
+                # released once the caller closes the response.
+                if stream and response is not None and response.status_code < 400:
+                    self.rate_limiter.adapt(throttled)
+                else:
+                    self.rate_limiter.release(throttled)
+            if error is None and response.status_code not in RETRY_STATUSES:
+                self._breaker.record_success()
+                response.raise_for_status()
+                return response
+
+            if self._breaker.record_failure():
+                raise CircuitOpenError('Circuit opened after {failures} consecutive failed requests to {url}.'.format(
+                    failures=self._breaker.failures, url=url))
+            delay = self._retry.backoff(attempt, response)
+            if not self._retry.reserve_wait(attempt, delay):
+                break
+            reason = error or 'HTTP {status}'.format(status=response.status_code)
+            logger.warning('Retrying {url} in {delay:.1f}s after {reason}.'.format(url=url, delay=delay, reason=reason))
+            if response is not None:
+                response.close()
+            self._count('retries', 'http_retries', endpoint)
+            time.sleep(delay)
+            attempt += 1
+
+        if error is not None:
+            raise error
         if response.status_code == 500:
             raise IgnoreHttpException("http status is 500.")
         response.raise_for_status()
-        return response.json()
-
+        return response
 
-    def _construct_endpoint(self, path):
-        return self._url_template.format(protocol=self.protocol, 
-                                         subdomain=self.subdomain, 
-                                         domain=self.domain, 
-                                         api_prefix=self.api_prefix,
-                                         path=path,
-                                         private_key=self.private_key)
 
-
-    def _set_page_in_endpoint(self, endpoint, page=0):
-        if "&page=" not in endpoint:
-            endpoint += "&page=0&limit={limit}".format(limit=self._limit)
-        else:
-            array = endpoint.split('&')
-            index = 0
-            while index < len(array):
-                if "page=" in array[index]:
-                    array[index] = "page=" + str(page)
-                index += 1
-            endpoint = '&'.join(array)
-        return endpoint
-
-
-    def _add_filter(self, endpoint, api_version, column_name, bookmark):
-        if column_name is None:
-            return endpoint
-        if bookmark is None:
-            if api_version == 'V2':
-                endpoint += '&where={{"{column_name}":{{"$isnot":"null"}}}}&order={column_name} ASC'.format(column_name=column_name)
-            else:
-                endpoint += '&filter={column_name} IS NOT NULL&order={column_name} ASC'.format(column_name=column_name)
-            return endpoint
-        if api_version == 'V2':
-            endpoint += '&where={{"{column_name}":{{"$gt":"{bookmark}"}}}}&order={column_name} ASC'.format(column_name=column_name, bookmark=bookmark)
-        else:
-            endpoint += '&filter={column_name} > {bookmark}&order={column_name} ASC'.format(column_name=column_name, bookmark=bookmark)
-        return endpoint
+    # Tallies `attribute` for connection_stats and the run's metrics, and
+    # emits it as a Singer metric.
+    def _count(self, attribute, metric, endpoint=None):
+        with self._stats_lock:
+            setattr(self, '_' + attribute, getattr(self, '_' + attribute) + 1)
+        RUN_METRICS.count(attribute, endpoint, self.tenant)
+        with metrics.Counter(metric, {metrics.Tag.endpoint: endpoint}) as counter:
+            counter.increment()
 
 
-    def _get_response(self, endpoint, key=None):
+    def _get(self, url, **kwargs):
+        return self._request(url).json()
+
+
+    @property
+    def base_url(self):
+        if self._base_url:
+            return self._base_url
+        return '{protocol}://{subdomain}.{domain}/{api_prefix}'.format(protocol=self.protocol,
+                                                                     subdomain=self.subdomain,
+                                                                     domain=self.domain,
+                                                                     api_prefix=self.api_prefix)
+
+
+    # With `project_fields`, V2 requests ask for only the stream's selected
+    # `fields`. V1 has no projection; its rows are pruned by the stream.
+    def _request_spec(self, path, api_version='V2', column_name=None, bookmark=None, until=None, fields=None):
+        spec = RequestSpec(self.base_url, path, self.private_key, api_version)
+        if fields:
+            spec.fields = list(fields)
+            if self.project_fields and api_version == 'V2':
+                spec.select = spec.fields
+        return spec.add_filter(column_name, bookmark, until)
+
+
+    def page_size_for(self, stream_name, learned_limit=None):
+        """ The page size to sync `stream_name` with, starting from the limit
+        learned on a previous run when adaptive sizing is enabled. """
+        limit = self._page_sizes.get(stream_name, self._limit)
+        if self._adaptive_page_size and learned_limit:
+            limit = learned_limit
+        return PageSize(limit, self._adaptive_page_size, **self._page_size_bounds)
+
+
+    # Returns the rows of one page and the size of the response body, or
+    # `None` rows when the page came back as a 500. With `stream`, the rows are
+    # a RowStream decoded as the body arrives and the size is known once read.
+    def _get_page(self, spec, page, key=None, limit=None, stream=False):
+        try:
+            response = self._request(spec.url(page, limit or self._limit), stream=stream, endpoint=spec.path)
+        except IgnoreHttpException:
+            if not self._skip_failed_pages:
+                raise
+            logger.info('Encountered 500, will ignore.')
+            return None, 0
+        if stream:
+            return RowStream(response, key, on_close=self.rate_limiter.release_slot,
+                             prune=spec.prune if spec.fields else None), 0
+        res = response.json()
+        res = res[key] if key is not None else res
+        if spec.fields:
+            res = [spec.prune(row) for row in res]
+        logger.info('Endpoint returned {length} rows.'.format(length=len(res)))
+        RUN_METRICS.observe_page(spec.path, self.tenant, len(res), len(response.content))
+        return res, len(response.content)
+
+
+    # Pages are addressed by row offset so that the limit can change between
+    # requests: page `offset // limit` of size `limit` always starts at `offset`.
+    def _get_pages(self, spec, key=None, page_size=None):
+        page_size = page_size or PageSize(self._limit)
+        if self._prefetch_pages > 1:
+            yield from self._get_pages_concurrently(spec, key, page_size)
+            return
         length = 1
-        page = 0
+        offset = page_size.offset
         while length > 0:
-            endpoint = self._set_page_in_endpoint(endpoint, page)
-            try:
-                res = self._get(endpoint)
-                res = res[key] if key is not None else res
-                length = len(res)
-                logger.info('Endpoint returned {length} rows.'.format(length=length))
-                for item in res:
-                    if 'heatMain' in endpoint and 'heatId' in item:
-                        self._new_heats.append(item['heatId'])
-                    yield item
-            except IgnoreHttpException:
-                logger.info('Encountered 500, will ignore.')
-                pass
+            limit = page_size.limit
+            page = offset // limit
+            started = time.time()
+            res, size = self._get_page(spec, page, key, limit, self._stream_json)
+            elapsed = time.time() - started
+            failed = res is None
+            if not failed:
+                page_size.offset = offset
+                try:
+                    yield page, res
+                finally:
+                    if isinstance(res, RowStream):
+                        res.close()
+                if isinstance(res, RowStream):
+                    logger.info('Endpoint returned {length} rows.'.format(length=res.count))
+                    RUN_METRICS.observe_page(spec.path, self.tenant, res.count, res.size)
+                    length, size, elapsed = res.count, res.size, elapsed + res.read_time
+                else:
+                    length = len(res)
+            # A failed page is retried at the same offset if the limit shrank.
+            page_size.update(offset if failed else offset + limit, elapsed, size, failed)
+            if not failed or page_size.limit == limit:
+                if failed:
+                    self._skip_page(spec, page)
+                offset += limit
             if self._test and page >= 2:
                 break
-            page += 1
 
 
+    # Keeps `_prefetch_pages` requests in flight ahead of the consumer while
+    # still yielding pages strictly in order. A short or empty page marks the
+    # end of the table and everything queued behind it is cancelled.
+    def _get_pages_concurrently(self, spec, key=None, page_size=None):
+        page_size = page_size or PageSize(self._limit)
+        limit = page_size.limit
+        executor = ThreadPoolExecutor(max_workers=self._prefetch_pages)
+        in_flight = collections.deque()
+        next_page = page_size.offset // limit
+        try:
+            while True:
+                while len(in_flight) < self._prefetch_pages and not (self._test and next_page > 2):
+                    in_flight.append(executor.submit(self._get_page, spec, next_page, key, limit))
+                    next_page += 1
+                if not in_flight:
+                    break
+                page = next_page - len(in_flight)
+                res, _ = in_flight.popleft().result()
+                if res is None:
+                    self._skip_page(spec, page)
+                    continue
+                page_size.offset = page * limit
+                yield page, res
+                if len(res) < limit:
+                    break
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+    def _skip_page(self, spec, page):
+        logger.warning('Skipping page {page} of {path}.'.format(page=page, path=spec.path))
+        self._count('skipped_pages', 'skipped_pages', spec.path)
+
+
+    def _get_response(self, spec, key=None, page_size=None):
+        page_size = page_size or PageSize(self._limit)
+        return PagedResponse(self._get_pages(spec, key, page_size), page_size)
+
+
+    # A single-row page is enough to check the key.
     def is_authorized(self):
-        endpoint = self._construct_endpoint('payments')
-        return self._get(endpoint)
+        return self._get(self._request_spec('payments').url(0, 1))
+
+
+    def booking(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('booking', 'V1', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'bookings', page_size)
+
+
+    def booking_availability(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('bookingAvailability', 'V1', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'bookings', page_size)
+
+
+    def check_details(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('checkDetails', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'checkDetails', page_size)
+
+
+    def checks(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('checks', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'checks', page_size)
 
 
-    def booking(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('booking')
-        endpoint = self._add_filter(endpoint, 'V1', column_name, bookmark)
-        return self._get_response(endpoint, 'bookings')
+    def check_totals(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('checkTotals', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def booking_availability(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('bookingAvailability')
-        endpoint = self._add_filter(endpoint, 'V1', column_name, bookmark)
-        return self._get_response(endpoint, 'bookings')
+    def customers(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('customers', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def check_details(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('checkDetails')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint, 'checkDetails')
+    def discount_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('discountType', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def checks(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('checks')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint, 'checks')
+    def event_heat_details(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventHeatDetails', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def check_totals(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('checkTotals')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_heat_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventHeatTypes', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def customers(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('customers')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_reservation_links(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventReservationLinks', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def discount_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('discountType')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_reservations(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventReservations', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_heat_details(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventHeatDetails')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_reservation_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventReservationTypes', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_heat_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventHeatTypes')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_rounds(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventRounds', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_reservation_links(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventReservationLinks')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def events(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('events', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_reservations(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventReservations')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_statuses(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventStatuses', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_reservation_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventReservationTypes')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_tasks(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventTasks', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_rounds(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventRounds')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_task_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventTaskTypes', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def events(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('events')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def event_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('eventTypes', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_statuses(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventStatuses')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def gift_card_history(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('giftCardHistory', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def event_tasks(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventTasks')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def _heat_details_spec(self, heat_ids, fields=None):
+        spec = self._request_spec('heatDetails', fields=fields)
+        spec.where = {"$or": [{"heatId": heat_id} for heat_id in heat_ids]}
+        spec.order = 'heatId ASC'
+        return spec
 
 
-    def event_task_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventTaskTypes')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    # Splits the captured heat IDs into `$or` batches of at most
+    # `_heat_batch_size` IDs whose URL stays within `_max_url_length`.
+    def _heat_details_specs(self, heat_ids, fields=None):
+        batch = []
+        for heat_id in heat_ids:
+            if batch and (len(batch) >= self._heat_batch_size or
+                          len(self._heat_details_spec(batch + [heat_id], fields).url()) + PAGE_PARAMS_LENGTH >
+                          self._max_url_length):
+                yield self._heat_details_spec(batch, fields)
+                batch = []
+            batch.append(heat_id)
+        if batch:
+            yield self._heat_details_spec(batch, fields)
 
 
-    def event_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('eventTypes')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def _get_all_rows(self, spec, page_size=None):
+        return list(self._get_response(spec, page_size=page_size))
 
 
-    def gift_card_history(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('giftCardHistory')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    # Fetches every batch through a pool of `_heat_detail_workers`, keeping
+    # at most that many batches in flight. Batches are yielded in order, or as
+    # soon as they complete when `heat_details_ordered` is off.
+    def _get_batches_concurrently(self, specs, page_size=None):
+        fetches = (functools.partial(self._get_all_rows, spec, page_size.fresh() if page_size else None)
+                   for spec in specs)
+        return self._fetch_concurrently(fetches, self._heat_detail_workers, self.heat_details_ordered)
+
+
+    def _fetch_concurrently(self, fetches, workers, ordered=True):
+        executor = ThreadPoolExecutor(max_workers=workers)
+        in_flight = collections.deque()
+        try:
+            for fetch in fetches:
+                in_flight.append(executor.submit(fetch))
+                if len(in_flight) >= workers:
+                    yield from self._pop_batch(in_flight, ordered)
+            while in_flight:
+                yield from self._pop_batch(in_flight, ordered)
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+    def _pop_batch(self, in_flight, ordered=True): # pylint: disable=no-self-use
+        if ordered:
+            future = in_flight.popleft()
+        else:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            future = done.pop()
+            in_flight.remove(future)
+        return future.result()
+
+
+    # Reads each (lower, upper] window of `column_name` with the stream
+    # method `method`, `workers` windows at a time. Rows come back window by
+    # window in order, so a bookmark taken from them only ever covers windows
+    # that were read in full. Each window is paged from its start.
+    def backfill(self, method, column_name, windows, page_size=None, fields=None, workers=1):
+        if workers <= 1:
+            for lower, upper in windows:
+                yield from method(column_name, lower, page_size=page_size.fresh() if page_size else None,
+                                  until=upper, fields=fields)
+            return
+        fetches = (functools.partial(self._get_window_rows, method, column_name, lower, upper,
+                                     page_size.fresh() if page_size else None, fields)
+                   for lower, upper in windows)
+        yield from self._fetch_concurrently(fetches, workers)
+
+
+    def _get_window_rows(self, method, column_name, lower, upper, page_size=None, fields=None): # pylint: disable=no-self-use
+        return list(method(column_name, lower, page_size=page_size, until=upper, fields=fields))
 
 
     # Note: This function pulls `heat_details` from the API, but since
     # the API doesn't have a `last_edited_at` field, we use `heat_main.finish`
-    # to determine when to pull `heat_details`.
-    def heat_main_details(self, column_name=None, bookmark=None):
-        endpoints = []
-        idx = 0
-        query = ''
-        endpoint_base = self._construct_endpoint('heatDetails')
-
-        # Using `heat_id`s, create array of endpoints for `heat_details`
-        for heat_id in self._new_heats:
-            query += '{{"heatId":{heat_id}}}'.format(heat_id=heat_id)
-            if (idx is not 0 and idx % 30 == 0) or idx == len(self._new_heats) - 1:
-                endpoint = endpoint_base + '&where={{"$or":[{query}]}}&order={column_name} ASC'.format(query=query, column_name='heatId')
-                endpoints.append(endpoint)
-                query = ''
-            else:
-                query += ','
-            idx += 1
-
-        # Yield all results from endpoints.
-        for endpoint in endpoints:
-            gtr = self._get_response(endpoint)
-            for item in gtr:
+    # to determine when to pull `heat_details`. The heats to fetch are the
+    # ones `heat_main` queued in the state; see `streams.HeatMainDetails`.
+    def heat_main_details(self, column_name=None, bookmark=None, page_size=None, heat_ids=(), fields=None):
+        specs = self._heat_details_specs(heat_ids, fields)
+        if self._heat_detail_workers > 1:
+            yield from self._get_batches_concurrently(specs, page_size)
+            return
+        for spec in specs:
+            for item in self._get_response(spec, page_size=page_size.fresh() if page_size else None):
                 yield item
 
 
-    def heat_main(self, column_name=None, bookmark=None):
-        self._new_heats = []
-        endpoint = self._construct_endpoint('heatMain')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def heat_main(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('heatMain', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def heat_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('heatTypes')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def heat_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('heatTypes', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def memberships(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('memberships')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def memberships(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('memberships', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def membership_types(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('membershipTypes')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def membership_types(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('membershipTypes', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def payments(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('payments')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def payments(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('payments', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def payments_voided(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('payments')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def payments_voided(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('payments', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def product_classes(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('productClasses')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def product_classes(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('productClasses', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def products(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('products')
-        endpoint = self._add_filter(endpoint, 'V1', column_name, bookmark)
-        return self._get_response(endpoint, 'products')
+    def products(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('products', 'V1', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'products', page_size)
 
 
-    def reservations(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('reservations')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint, 'reservations')
+    def reservations(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('reservations', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'reservations', page_size)
 
 
-    def sources(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('sources')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def sources(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('sources', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
-    def taxes(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('taxes')
-        endpoint = self._add_filter(endpoint, 'V1', column_name, bookmark)
-        return self._get_response(endpoint, 'taxes')
+    def taxes(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('taxes', 'V1', column_name, bookmark, until, fields)
+        return self._get_response(spec, 'taxes', page_size)
 
 
-    def users(self, column_name=None, bookmark=None):
-        endpoint = self._construct_endpoint('users')
-        endpoint = self._add_filter(endpoint, 'V2', column_name, bookmark)
-        return self._get_response(endpoint)
+    def users(self, column_name=None, bookmark=None, page_size=None, until=None, fields=None):
+        spec = self._request_spec('users', 'V2', column_name, bookmark, until, fields)
+        return self._get_response(spec, page_size=page_size)
 
 
 
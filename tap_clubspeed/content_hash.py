@@ -0,0 +1,48 @@
+import hashlib
+import json
+
+# Hex digits kept of each SHA-1; enough to tell rows and pages apart while
+# keeping the state small.
+DIGEST_LENGTH = 16
+
+
+def row_hash(row):
+    """ A digest of `row` that doesn't depend on the order of its keys. """
+    encoded = json.dumps(row, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:DIGEST_LENGTH]
+
+
+def row_key(row, key_properties):
+    return json.dumps([row.get(key) for key in key_properties], separators=(',', ':'), default=str)
+
+
+class TableHasher(object):
+    """ Hashes a table page by page as its rows are read. `page_hashes`
+    holds a digest per completed page; `finish` closes the last page and
+    returns the digest of the whole table. """
+
+    def __init__(self):
+        self.page_hashes = []
+        self._page = hashlib.sha1()
+        self._rows_in_page = 0
+
+
+    def add(self, digest, end_of_page=False):
+        """ Adds a row's digest; returns True if it closed a page. """
+        self._page.update(digest.encode('ascii'))
+        self._rows_in_page += 1
+        if end_of_page:
+            self._close_page()
+        return end_of_page
+
+
+    def _close_page(self):
+        self.page_hashes.append(self._page.hexdigest()[:DIGEST_LENGTH])
+        self._page = hashlib.sha1()
+        self._rows_in_page = 0
+
+
+    def finish(self):
+        if self._rows_in_page:
+            self._close_page()
+        return hashlib.sha1(''.join(self.page_hashes).encode('ascii')).hexdigest()[:DIGEST_LENGTH]
@@ -8,13 +8,27 @@ def get_abs_path(path):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
 
 
+# The discovered streams only depend on the bundled schemas, so they are
+# built once per process and handed out as fresh copies.
+CATALOG_TEXT = None
+
+
 def discover_streams(client):
+    global CATALOG_TEXT # pylint: disable=global-statement
+    if CATALOG_TEXT is None:
+        CATALOG_TEXT = json.dumps(build_streams(client))
+    return json.loads(CATALOG_TEXT)
+
+
+def build_streams(client):
     streams = []
 
     for s in STREAMS.values():
         s = s(client)
-        schema = singer.resolve_schema_references(s.load_schema())
-        streams.append({'stream': s.name, 'tap_stream_id': s.name, 'schema': schema, 'metadata': s.load_metadata()})
+        schema = s.load_schema()
+        metadata = s.load_metadata(schema)
+        schema = singer.resolve_schema_references(schema)
+        streams.append({'stream': s.name, 'tap_stream_id': s.name, 'schema': schema, 'metadata': metadata})
     return streams
 
 
@@ -0,0 +1,142 @@
+import codecs
+import json
+import time
+
+WHITESPACE = ' \t\n\r'
+CHUNK_SIZE = 64 * 1024
+DECODER = json.JSONDecoder()
+
+
+class _Buffer(object):
+    """ Decoded text of a response body that is read one chunk at a time.
+    Text before `pos` has been consumed and is dropped on the next read. """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self.eof = True
+            self.text = self.text[self.pos:] + self._decoder.decode(b'', True)
+        else:
+            self.text = self.text[self.pos:] + self._decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+
+    def peek(self):
+        """ The next non-whitespace character, or '' at the end of the body. """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {char!r} in JSON response, found {found!r}.'.format(char=char, found=found))
+        self.pos += 1
+
+
+    def value(self):
+        """ Decodes the next complete JSON value, reading until it is whole. A
+        value ending exactly at the end of the buffer (e.g. a number) is only
+        accepted once the next character or the end of the body is seen. """
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.text, self.pos)
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_rows(chunks, key=None):
+    """ Yields the elements of the top-level JSON array, or of the array under
+    `key` of the top-level object, as the body arrives in `chunks`. """
+    buf = _Buffer(chunks)
+    if key is not None:
+        buf.expect('{')
+        while True:
+            if buf.peek() == '}':
+                raise KeyError(key)
+            name = buf.value()
+            buf.expect(':')
+            if name == key:
+                break
+            buf.value()
+            if buf.peek() == ',':
+                buf.pos += 1
+
+    buf.expect('[')
+    if buf.peek() == ']':
+        return
+    while True:
+        yield buf.value()
+        char = buf.peek()
+        buf.pos += 1
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError('Expected \',\' or \']\' in JSON response, found {found!r}.'.format(found=char))
+
+
+class RowStream(object):
+    """ Rows of one page decoded straight off the response. Once exhausted,
+    `count`, `size` (bytes) and `read_time` (seconds spent reading) describe the page.
+    `on_close` is called once, when the response is closed, and `prune`, if
+    given, on each row as it is decoded. """
+
+    def __init__(self, response, key=None, on_close=None, prune=None):
+        self._response = response
+        self._on_close = on_close
+        self._prune = prune
+        self.count = 0
+        self.size = 0
+        self.read_time = 0.0
+        self._rows = iter_rows(self._chunks(), key)
+
+
+    def _chunks(self):
+        chunks = self._response.iter_content(CHUNK_SIZE)
+        while True:
+            started = time.time()
+            chunk = next(chunks, None)
+            self.read_time += time.time() - started
+            if chunk is None:
+                return
+            self.size += len(chunk)
+            yield chunk
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        row = next(self._rows)
+        self.count += 1
+        return row if self._prune is None else self._prune(row)
+
+
+    def close(self):
+        self._response.close()
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+
+import singer
+import singer.metrics as metrics
+
+LOGGER = singer.get_logger()
+
+DEFAULT_PIPELINE_QUEUE_SIZE = 1000
+# How often a stage blocked on a queue checks whether the pipeline stopped.
+POLL_SECONDS = 0.1
+
+END = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class StageTimer(object):
+    """ Wall time of one pipeline stage and how much of it was spent blocked
+    on a queue, waiting for the stage before it or for room in the next. """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.finished = None
+        self.blocked = 0.0
+
+
+    def start(self):
+        self.started = time.time()
+
+
+    def stop(self):
+        self.finished = time.time()
+
+
+    @property
+    def busy(self):
+        if self.started is None:
+            return 0.0
+        return max((self.finished or time.time()) - self.started - self.blocked, 0.0)
+
+
+    @property
+    def utilization(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.busy / elapsed if elapsed > 0 else 0.0
+
+
+    def log(self, stream_name):
+        LOGGER.info('%s: %s stage %.0f%% busy (%.2fs busy, %.2fs blocked)',
+                    stream_name, self.name, self.utilization * 100, self.busy, self.blocked)
+        metrics.log(LOGGER, metrics.Point('timer', 'pipeline_stage_busy_seconds', self.busy,
+                                          {metrics.Tag.endpoint: stream_name, 'stage': self.name}))
+
+
+class StageQueue(object):
+    """ A bounded queue between two stages. Time a stage spends blocked on it
+    is added to that stage's timer; once `stop` is set, blocked stages raise
+    PipelineStopped rather than wait forever. """
+
+    def __init__(self, size, stop):
+        self._queue = queue.Queue(maxsize=int(size))
+        self._stop = stop
+
+
+    def put(self, item, timer):
+        started = time.time()
+        try:
+            while True:
+                try:
+                    self._queue.put(item, timeout=POLL_SECONDS)
+                    return
+                except queue.Full:
+                    if self._stop.is_set():
+                        raise PipelineStopped()
+        finally:
+            timer.blocked += time.time() - started
+
+
+    def get(self, timer):
+        started = time.time()
+        try:
+            while True:
+                try:
+                    return self._queue.get(timeout=POLL_SECONDS)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        raise PipelineStopped()
+        finally:
+            timer.blocked += time.time() - started
+
+
+class QueuedResponse(object):
+    """ Reads a response's rows on a fetch thread, `queue_size` rows ahead of
+    the consumer. `page_complete` and `position` reflect the row last handed
+    over, as they do on the response itself. """
+
+    def __init__(self, response, queue_size, stop, fetch_timer, consumer_timer):
+        self.page_complete = False
+        self.position = None
+        self._done = False
+        self._response = response
+        self._rows = StageQueue(queue_size, stop)
+        self._fetch_timer = fetch_timer
+        self._consumer_timer = consumer_timer
+        self._thread = threading.Thread(target=self._fetch, name='pipeline-fetch', daemon=True)
+        self._thread.start()
+
+
+    def _fetch(self):
+        self._fetch_timer.start()
+        try:
+            for row in self._response:
+                progress = (getattr(self._response, 'page_complete', False), getattr(self._response, 'position', None))
+                self._rows.put((row, progress, None), self._fetch_timer)
+            self._rows.put((END, None, None), self._fetch_timer)
+        except PipelineStopped:
+            pass
+        except Exception as e: # pylint: disable=broad-except
+            try:
+                self._rows.put((END, None, e), self._fetch_timer)
+            except PipelineStopped:
+                pass
+        finally:
+            self._fetch_timer.stop()
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        row, progress, error = self._rows.get(self._consumer_timer)
+        if row is END:
+            self._done = True
+            if error is not None:
+                raise error
+            raise StopIteration
+        self.page_complete, self.position = progress
+        return row
@@ -0,0 +1,95 @@
+import threading
+import time
+
+DEFAULT_MIN_REQUESTS_PER_SECOND = 0.5
+# Share of the configured rate won back by each successful request after
+# the rate has been cut.
+RECOVERY_STEP = 0.05
+
+
+class RateLimiter(object):
+    """ Paces every request the client makes, from any thread.
+
+    A token bucket lets through `rate` requests per second on average, with
+    bursts of up to `burst`, and at most `max_in_flight` requests may be
+    using a connection at once. Each throttled response halves the rate
+    (down to `min_rate`); any other response then wins back a step of the
+    configured rate. Without a `rate` only `max_in_flight` applies. """
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None, min_rate=DEFAULT_MIN_REQUESTS_PER_SECOND):
+        self.max_rate = float(rate) if rate else None
+        self.rate = self.max_rate
+        self.min_rate = min(float(min_rate), self.max_rate or float(min_rate))
+        self.burst = float(burst) if burst else max(1.0, self.max_rate or 1.0)
+        self.max_in_flight = int(max_in_flight) if max_in_flight else None
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.wait_seconds = 0.0
+        self._slots = threading.BoundedSemaphore(self.max_in_flight) if self.max_in_flight else None
+        self._lock = threading.Lock()
+
+
+    def take_token(self):
+        """ Takes a token, or returns how long until one is available. """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+    def acquire(self):
+        """ Blocks until a request may be sent; returns the seconds waited. """
+        started = time.monotonic()
+        if self._slots is not None:
+            self._slots.acquire()
+        if self.rate:
+            delay = self.take_token()
+            while delay:
+                time.sleep(delay)
+                delay = self.take_token()
+        waited = time.monotonic() - started
+        self.record_wait(waited)
+        return waited
+
+
+    def record_wait(self, waited):
+        with self._lock:
+            self.requests += 1
+            self.wait_seconds += waited
+
+
+    def release(self, throttled=False):
+        """ Marks a request acquired earlier as answered. """
+        self.release_slot()
+        self.adapt(throttled)
+
+
+    def release_slot(self):
+        """ Frees the in-flight slot of a request whose body has been read. """
+        if self._slots is not None:
+            self._slots.release()
+
+
+    def adapt(self, throttled=False):
+        """ Cuts the rate after a throttled response, or recovers some of it. """
+        if self.max_rate is None:
+            return
+        with self._lock:
+            if throttled:
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_STEP)
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'wait_seconds': self.wait_seconds,
+                'mean_wait_seconds': self.wait_seconds / self.requests if self.requests else 0.0
+            }
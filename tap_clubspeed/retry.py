@@ -0,0 +1,125 @@
+import email.utils
+import random
+import threading
+import time
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 1.0
+DEFAULT_MAX_BACKOFF = 60
+DEFAULT_MAX_RETRY_SECONDS = 600
+DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 10
+DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 60
+
+# Responses worth asking for again: rate limiting and server-side failures.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Responses telling us to slow down, as opposed to failing.
+THROTTLE_STATUSES = frozenset([429, 503])
+
+
+class RequestBudgetExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def retry_after_seconds(response):
+    """ The wait a `Retry-After` header asks for, in seconds, or None. """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class RetryPolicy(object):
+    """ How failed requests are retried over one run: up to `max_retries`
+    times per request, waiting a jittered exponential backoff (or what the
+    server's `Retry-After` asks for) between attempts. A run makes at most
+    `max_requests` requests, and stops retrying once `max_retry_seconds` have
+    been spent waiting. """
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 max_backoff=DEFAULT_MAX_BACKOFF, max_requests=None,
+                 max_retry_seconds=DEFAULT_MAX_RETRY_SECONDS):
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.max_backoff = float(max_backoff)
+        self.max_requests = int(max_requests) if max_requests else None
+        self.max_retry_seconds = float(max_retry_seconds)
+        self.requests = 0
+        self.retry_seconds = 0.0
+        self._lock = threading.Lock()
+
+
+    def start_request(self):
+        with self._lock:
+            if self.max_requests is not None and self.requests >= self.max_requests:
+                raise RequestBudgetExceeded('Request budget of {max_requests} requests spent.'.format(
+                    max_requests=self.max_requests))
+            self.requests += 1
+
+
+    def backoff(self, attempt, response=None):
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+
+    def reserve_wait(self, attempt, delay):
+        """ Whether attempt number `attempt` may wait `delay` seconds to retry. """
+        with self._lock:
+            if attempt >= self.max_retries or self.retry_seconds + delay > self.max_retry_seconds:
+                return False
+            self.retry_seconds += delay
+            return True
+
+
+class CircuitBreaker(object):
+    """ Opens after `threshold` consecutive failed requests, failing every
+    request fast for `cooldown` seconds. The first request after the cooldown
+    goes through; a success closes the circuit and a failure re-opens it. """
+
+    def __init__(self, threshold=DEFAULT_CIRCUIT_BREAKER_THRESHOLD, cooldown=DEFAULT_CIRCUIT_BREAKER_COOLDOWN):
+        self.threshold = int(threshold)
+        self.cooldown = float(cooldown)
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+
+    def before_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.cooldown:
+                raise CircuitOpenError('{failures} consecutive requests failed; not retrying for {cooldown}s.'.format(
+                    failures=self.failures, cooldown=self.cooldown))
+            self.opened_at = None
+
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+    def record_failure(self):
+        """ Returns True when this failure leaves the circuit open. """
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                self.opened_at = time.time()
+                return True
+            return False
@@ -0,0 +1,244 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+import singer
+
+LOGGER = singer.get_logger()
+
+DEFAULT_METRICS_INTERVAL = 15
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PAGE_ROWS_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000, 5000)
+# Where a stream's sync time goes: waiting on the API (requests and
+# decoding), bookmark filtering, transformation and writing output.
+PHASES = ('http', 'bookmark', 'transform', 'output')
+COUNTERS = (
+    ('bytes', 'clubspeed_response_bytes_total', 'Bytes of response bodies received.'),
+    ('retries', 'clubspeed_retries_total', 'Requests retried.'),
+    ('skipped_pages', 'clubspeed_skipped_pages_total', 'Pages skipped after a 500.'),
+    ('records', 'clubspeed_records_total', 'Records written.')
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def cumulative(self):
+        """ (upper bound, observations at or below it) per bucket, Prometheus style. """
+        total = 0
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            yield bound, total
+
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': dict(self.cumulative())}
+
+
+class RunMetrics(object):
+    """ Performance metrics of one run, from any thread. Requests are labelled
+    by API endpoint and tenant, sync time and records by stream and tenant;
+    a None tenant is left out of the labels. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.latency = {}
+            self.page_rows = {}
+            self.counters = {}
+            self.stream_seconds = {}
+
+
+    def observe_request(self, endpoint, tenant, seconds):
+        with self._lock:
+            self._histogram(self.latency, LATENCY_BUCKETS, endpoint, tenant).observe(seconds)
+
+
+    def observe_page(self, endpoint, tenant, rows, size):
+        with self._lock:
+            self._histogram(self.page_rows, PAGE_ROWS_BUCKETS, endpoint, tenant).observe(rows)
+            self._add(('bytes', endpoint, tenant), size)
+
+
+    def count(self, name, endpoint, tenant, value=1):
+        with self._lock:
+            self._add((name, endpoint, tenant), value)
+
+
+    def add_stream_seconds(self, stream, tenant, seconds):
+        """ Adds {phase: seconds} to a stream's time split. """
+        with self._lock:
+            split = self.stream_seconds.setdefault((stream, tenant), dict.fromkeys(PHASES, 0.0))
+            for phase, value in seconds.items():
+                split[phase] += value
+
+
+    def _histogram(self, histograms, buckets, endpoint, tenant):
+        key = (endpoint, tenant)
+        if key not in histograms:
+            histograms[key] = Histogram(buckets)
+        return histograms[key]
+
+
+    def _add(self, key, value):
+        self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def prometheus(self):
+        """ Every metric in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            self._histogram_lines(lines, 'clubspeed_request_duration_seconds',
+                                  'Time to an API response, per attempt.', self.latency)
+            self._histogram_lines(lines, 'clubspeed_page_rows', 'Rows per page returned.', self.page_rows)
+            for name, metric, description in COUNTERS:
+                label = 'stream' if name == 'records' else 'endpoint'
+                lines.extend(['# HELP {} {}'.format(metric, description), '# TYPE {} counter'.format(metric)])
+                for (counter, key, tenant), value in sorted(self.counters.items(), key=repr):
+                    if counter == name:
+                        lines.append('{}{} {}'.format(metric, format_labels(((label, key), ('tenant', tenant))), value))
+            metric = 'clubspeed_stream_seconds_total'
+            lines.extend(['# HELP {} Sync time per stream, split by phase.'.format(metric),
+                          '# TYPE {} counter'.format(metric)])
+            for (stream, tenant), split in sorted(self.stream_seconds.items(), key=repr):
+                for phase in PHASES:
+                    labels = format_labels((('stream', stream), ('tenant', tenant), ('phase', phase)))
+                    lines.append('{}{} {}'.format(metric, labels, split[phase]))
+            lines.extend(['# HELP clubspeed_run_start_timestamp_seconds When the run started.',
+                          '# TYPE clubspeed_run_start_timestamp_seconds gauge',
+                          'clubspeed_run_start_timestamp_seconds {}'.format(self.started)])
+        return '\n'.join(lines) + '\n'
+
+
+    def _histogram_lines(self, lines, metric, description, histograms): # pylint: disable=no-self-use
+        lines.extend(['# HELP {} {}'.format(metric, description), '# TYPE {} histogram'.format(metric)])
+        for (endpoint, tenant), histogram in sorted(histograms.items(), key=repr):
+            labels = (('endpoint', endpoint), ('tenant', tenant))
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(metric, format_labels(labels + (('le', bound),)), count))
+            lines.append('{}_sum{} {}'.format(metric, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(metric, format_labels(labels), histogram.count))
+
+
+    def report(self):
+        """ A summary of the run, by endpoint and by stream. """
+        with self._lock:
+            finished = time.time()
+            endpoints = {}
+            for (endpoint, tenant), histogram in self.latency.items():
+                entry = endpoints.setdefault((endpoint, tenant), {'endpoint': endpoint, 'tenant': tenant})
+                entry['requests'] = histogram.count
+                entry['request_seconds'] = histogram.to_dict()
+            for (endpoint, tenant), histogram in self.page_rows.items():
+                entry = endpoints.setdefault((endpoint, tenant), {'endpoint': endpoint, 'tenant': tenant})
+                entry['page_rows'] = histogram.to_dict()
+            streams = {}
+            for (stream, tenant), split in self.stream_seconds.items():
+                streams[(stream, tenant)] = {'stream': stream, 'tenant': tenant, 'seconds': dict(split)}
+            for (name, key, tenant), value in self.counters.items():
+                if name == 'records':
+                    entry = streams.setdefault((key, tenant), {'stream': key, 'tenant': tenant})
+                    entry['records'] = value
+                    seconds = sum(entry.get('seconds', {}).values())
+                    entry['records_per_second'] = value / seconds if seconds else None
+                else:
+                    entry = endpoints.setdefault((key, tenant), {'endpoint': key, 'tenant': tenant})
+                    entry[name] = value
+            return {
+                'started': self.started,
+                'finished': finished,
+                'duration_seconds': finished - self.started,
+                'endpoints': sorted(endpoints.values(), key=repr),
+                'streams': sorted(streams.values(), key=repr)
+            }
+
+
+def format_labels(labels):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in labels if value is not None]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# Written next to the target and renamed over it, so the node exporter never
+# reads a half-written file.
+def write_atomically(path, text):
+    temporary = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+RUN_METRICS = RunMetrics()
+
+
+class MetricsExporter(object):
+    """ Rewrites `textfile` from RUN_METRICS every `interval` seconds on a
+    background thread until stopped. """
+
+    def __init__(self, textfile, interval=DEFAULT_METRICS_INTERVAL):
+        self.textfile = textfile
+        self.interval = float(interval)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-export', daemon=True)
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+
+
+    def export(self):
+        try:
+            write_atomically(self.textfile, RUN_METRICS.prometheus())
+        except OSError as e:
+            LOGGER.warning('Could not write metrics to %s: %s', self.textfile, e)
+
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.export()
+
+
+# Collects RUN_METRICS for the duration of a sync, exporting them to the
+# `metrics_textfile` while it runs and writing a `metrics_report` at the end,
+# when those are configured.
+@contextlib.contextmanager
+def export_metrics(config):
+    RUN_METRICS.reset()
+    exporter = None
+    if config.get('metrics_textfile'):
+        exporter = MetricsExporter(config['metrics_textfile'],
+                                   config.get('metrics_interval', DEFAULT_METRICS_INTERVAL))
+        exporter.start()
+    try:
+        yield RUN_METRICS
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        if config.get('metrics_report'):
+            write_atomically(config['metrics_report'], json.dumps(RUN_METRICS.report(), indent=2) + '\n')
@@ -1,30 +1,109 @@
 import os
 import json
 import datetime
-import pytz
+import time
 import singer
 from singer import metadata
-from singer import utils
-from singer.metrics import Point
-from dateutil.parser import parse
+from tap_clubspeed.content_hash import row_hash, row_key, TableHasher
+from tap_clubspeed.timestamps import parse_datetime, format_like, TimestampParser, UTC
+from tap_clubspeed.transform import is_field_dropped
 
 
 logger = singer.get_logger()
 KEY_PROPERTIES = ['id']
+# Added to every record, and to the key properties, when several tenants
+# are synced together.
+TENANT_FIELD = '_sdc_tenant'
+# How window bounds are written when the bookmark is in no format we can
+# copy; the format Clubspeed returns.
+WINDOW_BOUND_FORMAT = '%Y-%m-%d %H:%M:%S'
+# What FULL_TABLE streams emit; see `Stream.sync_full_table`.
+FULL_TABLE_DELTA_MODES = ('off', 'table', 'rows')
+DEFAULT_FULL_TABLE_MAX_HELD_ROWS = 10000
 
 
 def get_abs_path(path):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
 
 
+# Schema files are read once per process. The text is kept rather than the
+# parsed schema so every caller gets a fresh copy to modify.
+SCHEMA_TEXT = {}
+
+
+def read_schema(name):
+    text = SCHEMA_TEXT.get(name)
+    if text is None:
+        with open(get_abs_path("schemas/{}.json".format(name))) as f:
+            text = SCHEMA_TEXT[name] = f.read()
+    return json.loads(text)
+
+
 def needs_parse_to_date(string):
-    if isinstance(string, str):
-        try: 
-            parse(string)
-            return True
-        except ValueError:
-            return False
-    return False
+    return parse_datetime(string) is not None
+
+
+# Heat IDs are mostly consecutive, so queued IDs are kept in the state as
+# sorted `[first, last]` ranges rather than one entry per heat.
+def compress_ids(ids):
+    ranges = []
+    for value in sorted(set(ids)):
+        if ranges and value == ranges[-1][1] + 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ranges
+
+
+def expand_ids(ranges):
+    ids = []
+    for first, last in ranges or []:
+        ids.extend(range(first, last + 1))
+    return ids
+
+
+# Splits the range from `lower` (a bookmark, kept as is for the first
+# window) up to `until` into (lower, upper] windows of `window` each. Every
+# bound is written the way the bookmark is.
+def backfill_windows(lower, until, window):
+    start = parse_datetime(lower)
+    if start is None or until - start <= window:
+        return None
+    bookmark = lower
+    windows = []
+    while start < until:
+        start = min(start + window, until)
+        upper = format_like(start, bookmark, WINDOW_BOUND_FORMAT)
+        windows.append((lower, upper))
+        lower = upper
+    return windows
+
+
+class SyncOptions(object):
+    """ Config options that decide what streams sync, as opposed to how the
+    client talks to the API. `sync_started` is when the run began, the same
+    for every stream and tenant. """
+
+    def __init__(self, full_table_delta='off', full_table_max_held_rows=DEFAULT_FULL_TABLE_MAX_HELD_ROWS,
+                 backfill_window_days=None, backfill_workers=1, backfill_start_date=None, sync_started=None):
+        if full_table_delta not in FULL_TABLE_DELTA_MODES:
+            raise ValueError('Unknown full_table_delta {mode!r}.'.format(mode=full_table_delta))
+        self.full_table_delta = full_table_delta
+        self.full_table_max_held_rows = int(full_table_max_held_rows)
+        self.backfill_window_days = float(backfill_window_days) if backfill_window_days else None
+        self.backfill_workers = int(backfill_workers)
+        self.backfill_start_date = backfill_start_date
+        self.sync_started = sync_started or datetime.datetime.now(UTC)
+
+
+    @classmethod
+    def from_config(cls, config, sync_started=None):
+        return cls(config.get('full_table_delta', 'off'),
+                   config.get('full_table_max_held_rows', DEFAULT_FULL_TABLE_MAX_HELD_ROWS),
+                   config.get('backfill_window_days'),
+                   config.get('backfill_workers', 1),
+                   config.get('backfill_start_date'),
+                   sync_started)
 
 
 class Stream():
@@ -33,20 +112,52 @@ class Stream():
     replication_key = None
     stream = None
     key_properties = KEY_PROPERTIES
+    depends_on = ()
+    # Other streams' bookmarks this stream writes to, merged with its own.
+    shared_bookmarks = ()
+    # Wraps the client's response to read it on another thread; see
+    # `sync.sync_stream_pipelined`.
+    fetch_stage = None
+    # The tenant records are tagged with, if several are synced together.
+    tenant = None
+    # Names of every stream selected in the catalog being synced.
+    selected_streams = frozenset()
 
 
     def __init__(self, client=None):
         self.client = client
+        self.options = SyncOptions()
+        self.response = None
+        self._timestamps = TimestampParser()
+        self._bookmark = None
+        self._parsed_bookmark = None
+        self._filter = None
+        self._page_size = None
+        self._held_position = None
+        self._completed = False
+        # Time spent comparing rows against the bookmark, for the run's metrics.
+        self.bookmark_seconds = 0.0
 
 
     def get_bookmark(self, state):
         return singer.get_bookmark(state, self.name, self.replication_key)
 
 
-    def update_bookmark(self, state, value):
+    # The stored bookmark is only re-parsed when it changes, which during a
+    # sync is only when a newer row has been written to it.
+    def _get_parsed_bookmark(self, state):
         current_bookmark = self.get_bookmark(state)
-        if value and needs_parse_to_date(value) and needs_parse_to_date(current_bookmark):
-            if utils.strptime_with_tz(value) > utils.strptime_with_tz(current_bookmark):
+        if current_bookmark != self._bookmark:
+            self._bookmark = current_bookmark
+            self._parsed_bookmark = parse_datetime(current_bookmark)
+        return current_bookmark, self._parsed_bookmark
+
+
+    def update_bookmark(self, state, value):
+        current_bookmark, parsed_bookmark = self._get_parsed_bookmark(state)
+        parsed_value = self._timestamps.parse(value) if value else None
+        if parsed_value is not None and parsed_bookmark is not None:
+            if parsed_value > parsed_bookmark:
                 singer.write_bookmark(state, self.name, self.replication_key, value)
         elif current_bookmark is None:
             singer.write_bookmark(state, self.name, self.replication_key, value)
@@ -55,11 +166,12 @@ class Stream():
     # This function returns boolean and checks if
     # book mark is old.
     def is_bookmark_old(self, state, value):
-        current_bookmark = self.get_bookmark(state)
+        current_bookmark, parsed_bookmark = self._get_parsed_bookmark(state)
         if current_bookmark is None:
             return True
-        if needs_parse_to_date(current_bookmark) and needs_parse_to_date(value):
-            if utils.strptime_with_tz(value) >= utils.strptime_with_tz(current_bookmark):
+        parsed_value = self._timestamps.parse(value)
+        if parsed_bookmark is not None and parsed_value is not None:
+            if parsed_value >= parsed_bookmark:
                 return True
         else:
             if int(value) >= int(current_bookmark):
@@ -68,18 +180,15 @@ class Stream():
 
 
     def load_schema(self):
-        schema_file = "schemas/{}.json".format(self.name)
-        with open(get_abs_path(schema_file)) as f:
-            schema = json.load(f)
-        return self._add_custom_fields(schema)
+        return self._add_custom_fields(read_schema(self.name))
 
 
     def _add_custom_fields(self, schema): # pylint: disable=no-self-use
         return schema
 
 
-    def load_metadata(self):
-        schema = self.load_schema()
+    def load_metadata(self, schema=None):
+        schema = schema or self.load_schema()
         mdata = metadata.new()
 
         mdata = metadata.write(mdata, (), 'table-key-properties', self.key_properties)
@@ -101,37 +210,208 @@ class Stream():
         return self.stream is not None
 
 
+    # The fields records keep: the catalog's selected and automatic
+    # properties plus the key properties and replication key. None when
+    # nothing is deselected. The client cuts rows down to these as pages are
+    # decoded, before bookmarks, transformation and any queue between them.
+    def selected_fields(self):
+        if self.stream is None:
+            return None
+        mdata = metadata.to_map(self.stream.metadata)
+        properties = self.stream.schema.to_dict().get('properties', {})
+        fields = [name for name in properties if not is_field_dropped(mdata, name)]
+        if len(fields) == len(properties):
+            return None
+        required = list(self.key_properties) + ([self.replication_key] if self.replication_key in properties else [])
+        return sorted(set(fields + required))
+
+
+    def open_response(self, res):
+        self.response = self.fetch_stage(res) if self.fetch_stage else res
+        return self.response
+
+
+    # True when the row last yielded by `sync` closed a page of the response.
+    def at_page_boundary(self):
+        if self._held_position is not None:
+            return False
+        return getattr(self.response, 'page_complete', False)
+
+
+    # The (offset, limit) of the page the row last read came from.
+    def position(self):
+        return getattr(self.response, 'position', None) or (self._page_size.offset, self._page_size.limit)
+
+
+    # Called before each STATE message. Records the request in flight as a
+    # `page_cursor` (its filter and the page to restart at) so a restarted
+    # sync re-fetches at most one page. At a page boundary the cursor points
+    # past the page just written.
+    def checkpoint(self, state):
+        page_size = self._page_size
+        if page_size is None:
+            return
+        if self._completed:
+            singer.clear_bookmark(state, self.name, 'page_cursor')
+            return
+        offset, limit = self._held_position or self.position()
+        page = offset // limit
+        if self.at_page_boundary():
+            page += 1
+        singer.write_bookmark(state, self.name, 'page_cursor',
+                              {'filter': self._filter, 'page': page, 'limit': limit})
+
+
+    # With `backfill_window_days` set, an incremental stream more than one
+    # window behind reads from its bookmark (or `backfill_start_date`) up to
+    # the start of the sync in windows. The fixed upper bound also keeps
+    # offsets stable while new rows are written.
+    def get_backfill_windows(self, bookmark):
+        window_days = self.options.backfill_window_days
+        if not window_days or self.replication_method != "INCREMENTAL":
+            return None
+        lower = bookmark or self.options.backfill_start_date
+        if not lower:
+            return None
+        return backfill_windows(lower, self.options.sync_started, datetime.timedelta(days=window_days))
+
+
+    def get_page_size(self, state):
+        return self.client.page_size_for(self.name, singer.get_bookmark(state, self.name, 'page_size'))
+
+
+    # Start the next run at the page size learned during this one.
+    def save_page_size(self, state, page_size):
+        if page_size.adaptive:
+            singer.write_bookmark(state, self.name, 'page_size', page_size.limit)
+
+
     # The main sync function.
     def sync(self, state):
         get_data = getattr(self.client, self.name)
 
         bookmark = self.get_bookmark(state)
-
-        res = get_data(self.replication_key, bookmark)
+        page_size = self.get_page_size(state)
+
+        cursor = singer.get_bookmark(state, self.name, 'page_cursor')
+        if cursor:
+            logger.info('Resuming {stream} at page {page} of {limit} rows.'.format(stream=self.name,
+                                                                                  page=cursor['page'],
+                                                                                  limit=cursor['limit']))
+            bookmark = cursor['filter']
+            page_size.resume(cursor['page'], cursor['limit'])
+
+        fields = self.selected_fields()
+        windows = None if cursor else self.get_backfill_windows(bookmark)
+        if windows:
+            logger.info('Backfilling {stream} in {count} windows up to {until}.'.format(stream=self.name,
+                                                                                       count=len(windows),
+                                                                                       until=windows[-1][1]))
+            # Windows are read whole, so there is no page to resume at.
+            self._page_size = None
+            res = self.open_response(self.client.backfill(get_data, self.replication_key, windows,
+                                                          page_size=page_size, fields=fields,
+                                                          workers=self.options.backfill_workers))
+        else:
+            self._filter = bookmark
+            self._page_size = page_size
+            res = self.open_response(get_data(self.replication_key, bookmark, page_size=page_size, fields=fields))
+        self._completed = False
 
         if self.replication_method == "INCREMENTAL":
             for item in res:
+                started = time.time()
                 try:
-                    if self.is_bookmark_old(state, item[self.replication_key]):
+                    keep = self.is_bookmark_old(state, item[self.replication_key])
+                    if keep:
                         self.update_bookmark(state, item[self.replication_key])
-                        yield (self.stream, item)
 
                 except KeyError:
                     logger.info('Bookmark doesn\'t exist: syncing row.')
-                    yield (self.stream, item)
-                    pass
+                    keep = True
 
                 except Exception as e:
                     logger.error('Handled exception: {error}'.format(error=str(e)))
-                    pass
+                    keep = False
+
+                self.bookmark_seconds += time.time() - started
+                if keep:
+                    yield (self.stream, item)
 
         elif self.replication_method == "FULL_TABLE":
-            for item in res:
-                yield (self.stream, item)
+            yield from self.sync_full_table(state, res, resumed=bool(cursor))
 
         else:
             raise Exception('Replication key not defined for {stream}'.format(self.name))
 
+        self._completed = True
+        self.save_page_size(state, page_size)
+
+
+    # Rows are hashed as they are read and the hash of the table and of each
+    # page kept in the state. The `full_table_delta` option decides what is
+    # emitted: every row ("off"), nothing if the table is unchanged ("table"),
+    # or only rows that are new or changed by key ("rows"). A table resumed
+    # from a page cursor can't be compared whole, so it is emitted in full.
+    def sync_full_table(self, state, res, resumed=False):
+        mode = self.options.full_table_delta
+        max_held_rows = self.options.full_table_max_held_rows
+        previous_pages = singer.get_bookmark(state, self.name, 'page_hashes') or []
+        previous_rows = singer.get_bookmark(state, self.name, 'row_hashes') or {}
+        row_hashes = dict(previous_rows) if resumed else {}
+        hasher = TableHasher()
+
+        # Pages identical to the last run are held back until a page differs,
+        # or until more than `max_held_rows` are waiting.
+        holding = mode == 'table' and not resumed and bool(previous_pages)
+        held = []
+
+        for item in res:
+            digest = row_hash(item)
+            page_ended = hasher.add(digest, self.at_page_boundary())
+            if mode == 'rows':
+                key = row_key(item, self.key_properties)
+                row_hashes[key] = digest
+                if previous_rows.get(key) != digest:
+                    yield (self.stream, item)
+            elif holding:
+                held.append((self.position(), item))
+                page = len(hasher.page_hashes) - 1
+                if page_ended and previous_pages[page:page + 1] != hasher.page_hashes[page:]:
+                    holding = False
+                elif len(held) > max_held_rows:
+                    logger.info('{stream}: over {count} unchanged rows held; emitting every row.'.format(
+                        stream=self.name, count=max_held_rows))
+                    holding = False
+                if not holding:
+                    yield from self.release_held(held)
+                    held = []
+            else:
+                yield (self.stream, item)
+
+        table_hash = hasher.finish()
+        if holding and hasher.page_hashes == previous_pages:
+            logger.info('{stream} is unchanged; skipping {count} rows.'.format(stream=self.name, count=len(held)))
+        else:
+            yield from self.release_held(held)
+
+        if not resumed:
+            singer.write_bookmark(state, self.name, 'table_hash', table_hash)
+            singer.write_bookmark(state, self.name, 'page_hashes', hasher.page_hashes)
+        if mode == 'rows':
+            singer.write_bookmark(state, self.name, 'row_hashes', row_hashes)
+
+
+    # Yields the rows `sync_full_table` held back, each kept with the
+    # (offset, limit) of its page. The response has already read past them,
+    # so until the last one is out a checkpoint points at the page of the
+    # row being released.
+    def release_held(self, held):
+        for index, (position, item) in enumerate(held):
+            self._held_position = position if index < len(held) - 1 else None
+            yield (self.stream, item)
+        self._held_position = None
+
 
 
 class Booking(Stream):
@@ -257,17 +537,54 @@ class GiftCardHistory(Stream):
     key_properties = [ "giftCardHistoryId" ]
 
 
+def get_pending_heat_ids(state):
+    return expand_ids(singer.get_bookmark(state, HeatMainDetails.name, 'pending_heat_ids'))
+
+
+def set_pending_heat_ids(state, heat_ids):
+    singer.write_bookmark(state, HeatMainDetails.name, 'pending_heat_ids', compress_ids(heat_ids))
+
+
+# While heat_main_details is selected, every heat synced here is queued in
+# heat_main_details' bookmark for it to fetch.
 class HeatMain(Stream):
     name = "heat_main"
     replication_method = "INCREMENTAL"
     replication_key = "finish"
     key_properties = [ "heatId" ]
+    shared_bookmarks = ("heat_main_details",)
+
+
+    def __init__(self, client=None):
+        super().__init__(client)
+        self._pending_heat_ids = None
+
+
+    def sync(self, state):
+        if HeatMainDetails.name not in self.selected_streams:
+            yield from super().sync(state)
+            return
+
+        self._pending_heat_ids = set(get_pending_heat_ids(state))
+        for stream, item in super().sync(state):
+            if item.get('heatId') is not None:
+                self._pending_heat_ids.add(item['heatId'])
+            yield (stream, item)
+
+
+    def checkpoint(self, state):
+        super().checkpoint(state)
+        if self._pending_heat_ids is not None:
+            set_pending_heat_ids(state, self._pending_heat_ids)
 
 
 #
-# This table uses heat_main's bookmark as it's bookmark,
-# but to allow this to work, we give the replication_key
-# an intentional "None".
+# This table has no bookmark of its own: it fetches the details of the heats
+# heat_main queued in its `pending_heat_ids`. Details come back in heat order
+# unless `heat_details_ordered` is off, so a heat is only dropped from the
+# queue once a later heat's details are seen (or the sync completes). With it
+# off there is no such point before the end: checkpoints keep the whole queue,
+# and an interrupted sync fetches every heat again.
 #
 
 class HeatMainDetails(Stream):
@@ -275,6 +592,40 @@ class HeatMainDetails(Stream):
     replication_method = "INCREMENTAL"
     replication_key = "None"
     key_properties = [ "heatId" ]
+    depends_on = ("heat_main",)
+
+
+    def __init__(self, client=None):
+        super().__init__(client)
+        self._pending_heat_ids = None
+        self._done = 0
+
+
+    def sync(self, state):
+        self._pending_heat_ids = sorted(get_pending_heat_ids(state))
+        self._done = 0
+        if not self._pending_heat_ids:
+            return
+
+        ordered = getattr(self.client, 'heat_details_ordered', True)
+        page_size = self.get_page_size(state)
+        res = self.open_response(self.client.heat_main_details(page_size=page_size, heat_ids=self._pending_heat_ids,
+                                                               fields=self.selected_fields()))
+
+        for item in res:
+            if ordered:
+                heat_id = item.get('heatId')
+                while self._done < len(self._pending_heat_ids) and self._pending_heat_ids[self._done] < heat_id:
+                    self._done += 1
+            yield (self.stream, item)
+
+        self._done = len(self._pending_heat_ids)
+        self.save_page_size(state, page_size)
+
+
+    def checkpoint(self, state):
+        if self._pending_heat_ids is not None:
+            set_pending_heat_ids(state, self._pending_heat_ids[self._done:])
 
 
 class HeatTypes(Stream):
@@ -1,29 +1,403 @@
+import copy
 import json
+import queue
+import sys
+import threading
+import time
 
 import singer
 import singer.metrics as metrics
-from singer import metadata
-from singer import Transformer
+
+from tap_clubspeed.pipeline import END, PipelineStopped, QueuedResponse, StageQueue, StageTimer
+from tap_clubspeed.run_metrics import RUN_METRICS, PHASES
+from tap_clubspeed.streams import TENANT_FIELD
+from tap_clubspeed.transform import RecordTransformer
 
 LOGGER = singer.get_logger()
 
+DEFAULT_STATE_FLUSH_RECORDS = 1000
+DEFAULT_STATE_FLUSH_SECONDS = 60
+DEFAULT_OUTPUT_BUFFER_SIZE = 64 * 1024
+DEFAULT_OUTPUT_QUEUE_SIZE = 1000
+
+# Streams may sync on worker threads; every Singer message is written under
+# this lock so lines on stdout never interleave.
+OUTPUT_LOCK = threading.RLock()
+
+# Compact and C-accelerated; matches singer's `allow_nan=False`.
+RECORD_ENCODER = json.JSONEncoder(separators=(',', ':'), allow_nan=False)
+
+
+class MessageWriter(object):
+    """ Writes Singer messages to stdout.
+
+    RECORD messages are encoded with `RECORD_ENCODER` around a per-stream
+    prefix and collected until `buffer_size` characters are waiting; stdout is
+    only flushed when a STATE message is written. With `threaded`, records are
+    encoded and written on a separate thread fed through a queue of
+    `queue_size` messages, so fetching and output overlap. """
+
+    def __init__(self, buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE, threaded=False,
+                 queue_size=DEFAULT_OUTPUT_QUEUE_SIZE):
+        self._prefixes = {}
+        self._buffer = []
+        self._buffered = 0
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self.configure(buffer_size, threaded, queue_size)
+
+
+    def configure(self, buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE, threaded=False,
+                  queue_size=DEFAULT_OUTPUT_QUEUE_SIZE):
+        self.close()
+        self.buffer_size = int(buffer_size)
+        if threaded:
+            self._queue = queue.Queue(maxsize=int(queue_size))
+            self._thread = threading.Thread(target=self._run, name='singer-output', daemon=True)
+            self._thread.start()
+
+
+    def write_record(self, stream_name, record):
+        self._put((stream_name, record, False))
+
+
+    def write_message(self, message, flush=False):
+        # Encoded now: a STATE message's state keeps changing after this call.
+        self._put((None, singer.format_message(message), flush))
+
+
+    def flush(self):
+        """ Writes out everything handed over so far. """
+        if self._queue is not None:
+            self._queue.join()
+            self._raise_error()
+        else:
+            self._write(flush=True)
+
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+            self._raise_error()
+        self._write(flush=True)
+
+
+    def _put(self, item):
+        if self._queue is None:
+            self._handle(item)
+            return
+        self._raise_error()
+        self._queue.put(item)
+
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    self._handle(item)
+            except Exception as e: # pylint: disable=broad-except
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+    def _handle(self, item):
+        stream_name, payload, flush = item
+        if stream_name is None:
+            self._append(payload + '\n')
+            if flush:
+                self._write(flush=True)
+            return
+        self._append(self._encode_record(stream_name, payload))
+        if self._buffered >= self.buffer_size:
+            self._write()
+
+
+    def _encode_record(self, stream_name, record):
+        prefix = self._prefixes.get(stream_name)
+        if prefix is None:
+            prefix = '{{"type":"RECORD","stream":{stream},"record":'.format(stream=json.dumps(stream_name))
+            self._prefixes[stream_name] = prefix
+        try:
+            return prefix + RECORD_ENCODER.encode(record) + '}\n'
+        except (TypeError, ValueError):
+            # e.g. Decimal values, which singer's encoder handles.
+            return singer.format_message(singer.RecordMessage(stream=stream_name, record=record)) + '\n'
+
+
+    def _append(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+
+
+    def _write(self, flush=False):
+        if self._buffer:
+            sys.stdout.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        if flush:
+            sys.stdout.flush()
+
+
+OUTPUT = MessageWriter()
+# The last SCHEMA message written per stream this run; tenants synced side
+# by side would otherwise repeat the same one.
+SCHEMAS_WRITTEN = {}
+
+
+def configure_output(config):
+    SCHEMAS_WRITTEN.clear()
+    OUTPUT.configure(config.get('output_buffer_size', DEFAULT_OUTPUT_BUFFER_SIZE),
+                     config.get('threaded_output', False),
+                     config.get('output_queue_size', DEFAULT_OUTPUT_QUEUE_SIZE))
+
+
+def write_schema(stream_name, schema, key_properties):
+    with OUTPUT_LOCK:
+        if SCHEMAS_WRITTEN.get(stream_name) == (schema, key_properties):
+            return
+        SCHEMAS_WRITTEN[stream_name] = copy.deepcopy((schema, key_properties))
+        OUTPUT.write_message(singer.SchemaMessage(stream=stream_name, schema=schema, key_properties=key_properties))
 
-def sync_stream(state, instance):
+
+def write_record(stream_name, record):
+    with OUTPUT_LOCK:
+        OUTPUT.write_record(stream_name, record)
+
+
+def write_state(state):
+    with OUTPUT_LOCK:
+        OUTPUT.write_message(singer.StateMessage(value=state), flush=True)
+
+
+class StateEmitter(object):
+    """ Owns the state written to stdout. Streams syncing concurrently work on
+    their own copy of the state; their bookmark is merged in before each write.
+    When `state` is one tenant's part of a larger state, `root` is what gets
+    written. """
+
+    def __init__(self, state, root=None):
+        self.state = state
+        self.root = state if root is None else root
+
+
+    def snapshot(self):
+        with OUTPUT_LOCK:
+            return copy.deepcopy(self.state)
+
+
+    def write(self, stream_name, stream_state, shared_bookmarks=()):
+        with OUTPUT_LOCK:
+            if stream_state is not self.state:
+                for name in (stream_name,) + tuple(shared_bookmarks):
+                    bookmark = stream_state.get('bookmarks', {}).get(name)
+                    if bookmark is not None:
+                        bookmarks = self.state.setdefault('bookmarks', {})
+                        bookmarks[name] = copy.deepcopy(bookmark)
+            write_state(self.root)
+
+
+class StateFlushPolicy(object):
+    """ Decides when a stream's bookmark and page cursor are written out: after
+    every `every_records` records, after `every_seconds` seconds, and always
+    when a page of the response has been fully written. """
+
+    def __init__(self, every_records=DEFAULT_STATE_FLUSH_RECORDS,
+                 every_seconds=DEFAULT_STATE_FLUSH_SECONDS):
+        self.every_records = int(every_records)
+        self.every_seconds = float(every_seconds)
+
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('state_flush_records', DEFAULT_STATE_FLUSH_RECORDS),
+                   config.get('state_flush_seconds', DEFAULT_STATE_FLUSH_SECONDS))
+
+
+    def should_flush(self, pending_records, last_flush, at_page_boundary):
+        if pending_records == 0:
+            return False
+        return (at_page_boundary
+                or pending_records >= self.every_records
+                or time.time() - last_flush >= self.every_seconds)
+
+
+class PhaseClock(object):
+    """ Splits a stream's sync time between phases: each `lap` charges the
+    time since the previous one to the phase named. """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self._last = time.time()
+
+
+    def lap(self, phase):
+        now = time.time()
+        self.seconds[phase] += now - self._last
+        self._last = now
+
+
+# The stream times its own bookmark filtering, which is moved out of the
+# phase it ran in: waiting on rows, or the transform stage of a pipeline.
+def record_stream_metrics(instance, seconds, records, filtered_in='http'):
+    seconds = dict(seconds)
+    seconds['bookmark'] = instance.bookmark_seconds
+    seconds[filtered_in] = max(seconds[filtered_in] - instance.bookmark_seconds, 0.0)
+    RUN_METRICS.add_stream_seconds(instance.stream.tap_stream_id, instance.tenant, seconds)
+    RUN_METRICS.count('records', instance.stream.tap_stream_id, instance.tenant, records)
+
+
+def sync_stream(state, instance, emitter=None, flush_policy=None, pipeline_queue_size=0):
     stream = instance.stream
+    emitter = emitter or StateEmitter(state)
+    flush_policy = flush_policy or StateFlushPolicy()
+    if pipeline_queue_size:
+        return sync_stream_pipelined(state, instance, emitter, flush_policy, pipeline_queue_size)
+
+    # The bookmark only moves past a row once that row is written, so a STATE
+    # message written after a record never runs ahead of the output.
+    pending_records = 0
+    last_flush = time.time()
+    clock = PhaseClock()
+
+    with metrics.record_counter(stream.tap_stream_id) as counter, \
+         metrics.Counter('state_count', {metrics.Tag.endpoint: stream.tap_stream_id}) as state_counter, \
+         RecordTransformer(stream) as transformer:
+        try:
+            for (stream, record) in instance.sync(state):
+                clock.lap('http')
+                counter.increment()
+
+                try:
+                    record = transformer.transform(record)
+                    if instance.tenant is not None:
+                        record[TENANT_FIELD] = instance.tenant
+                    clock.lap('transform')
+                    write_record(stream.tap_stream_id, record)
+                    pending_records += 1
+
+                except Exception as e:
+                    LOGGER.error('Handled exception: {error}'.format(error=str(e)))
+                    clock.lap('transform')
+                    continue
+
+                if flush_policy.should_flush(pending_records, last_flush, instance.at_page_boundary()):
+                    instance.checkpoint(state)
+                    emitter.write(stream.tap_stream_id, state, instance.shared_bookmarks)
+                    state_counter.increment()
+                    pending_records = 0
+                    last_flush = time.time()
+                clock.lap('output')
+
+            instance.checkpoint(state)
+            emitter.write(instance.stream.tap_stream_id, state, instance.shared_bookmarks)
+            state_counter.increment()
+            clock.lap('output')
+            return counter.value
+        finally:
+            record_stream_metrics(instance, clock.seconds, counter.value)
+
+
+def _bookmarks_snapshot(state, names):
+    bookmarks = state.get('bookmarks', {})
+    return {'bookmarks': {name: copy.deepcopy(bookmarks[name]) for name in names if name in bookmarks}}
+
+
+# The same sync as `sync_stream`, split into three stages that overlap:
+# fetching rows (a thread reading the response ahead), filtering and
+# transforming them (a second thread), and writing output (this thread).
+# Stages hand over through queues of `queue_size` items, so a slow stage
+# holds the others back rather than letting rows pile up. The transform
+# stage works on its own copy of the state and queues a snapshot of its
+# bookmarks behind the records they cover, so STATE never runs ahead of the
+# output.
+def sync_stream_pipelined(state, instance, emitter, flush_policy, queue_size):
+    stream_name = instance.stream.tap_stream_id
+    bookmark_names = (stream_name,) + tuple(instance.shared_bookmarks)
+    work_state = copy.deepcopy(state)
+    stop = threading.Event()
+    fetch_timer, transform_timer, output_timer = StageTimer('fetch'), StageTimer('transform'), StageTimer('output')
+    messages = StageQueue(queue_size, stop)
+    instance.fetch_stage = lambda res: QueuedResponse(res, queue_size, stop, fetch_timer, transform_timer)
+
+    def checkpoint():
+        instance.checkpoint(work_state)
+        messages.put(('state', _bookmarks_snapshot(work_state, bookmark_names)), transform_timer)
 
-    with metrics.record_counter(stream.tap_stream_id) as counter:
-        for (stream, record) in instance.sync(state):
-            counter.increment()
+    def transform():
+        transform_timer.start()
+        try:
+            pending_records = 0
+            last_flush = time.time()
+            with RecordTransformer(instance.stream) as transformer:
+                for (_, record) in instance.sync(work_state):
+                    try:
+                        record = transformer.transform(record)
+                        if instance.tenant is not None:
+                            record[TENANT_FIELD] = instance.tenant
+                    except Exception as e:
+                        LOGGER.error('Handled exception: {error}'.format(error=str(e)))
+                        messages.put(('skipped', None), transform_timer)
+                        continue
+                    messages.put(('record', record), transform_timer)
+                    pending_records += 1
 
+                    if flush_policy.should_flush(pending_records, last_flush, instance.at_page_boundary()):
+                        checkpoint()
+                        pending_records = 0
+                        last_flush = time.time()
+            checkpoint()
+            messages.put((END, None), transform_timer)
+        except PipelineStopped:
+            pass
+        except Exception as e: # pylint: disable=broad-except
             try:
-                with Transformer() as transformer:
-                    record = transformer.transform(record, stream.schema.to_dict(), metadata.to_map(stream.metadata))
-                singer.write_record(stream.tap_stream_id, record)
-                if instance.replication_method == "INCREMENTAL":
-                    singer.write_state(state)
+                messages.put(('error', e), transform_timer)
+            except PipelineStopped:
+                pass
+        finally:
+            transform_timer.stop()
 
-            except Exception as e:
-                LOGGER.error('Handled exception: {error}'.format(error=str(e)))
-                continue
+    with metrics.record_counter(stream_name) as counter, \
+         metrics.Counter('state_count', {metrics.Tag.endpoint: stream_name}) as state_counter:
+        thread = threading.Thread(target=transform, name='pipeline-transform', daemon=True)
+        output_timer.start()
+        thread.start()
+        try:
+            while True:
+                kind, payload = messages.get(output_timer)
+                if kind is END:
+                    break
+                if kind == 'error':
+                    raise payload
+                if kind == 'state':
+                    emitter.write(stream_name, payload, instance.shared_bookmarks)
+                    state_counter.increment()
+                    continue
+                counter.increment()
+                if kind == 'record':
+                    write_record(stream_name, payload)
+        finally:
+            stop.set()
+            thread.join()
+            output_timer.stop()
+            instance.fetch_stage = None
 
+        for timer in (fetch_timer, transform_timer, output_timer):
+            timer.log(stream_name)
+        record_stream_metrics(instance, {'http': fetch_timer.busy, 'transform': transform_timer.busy,
+                                         'output': output_timer.busy}, counter.value, filtered_in='transform')
         return counter.value
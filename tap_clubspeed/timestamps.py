@@ -0,0 +1,81 @@
+import datetime
+import re
+
+# Clubspeed returns timestamps as `2018-11-03 18:21:26`, `2018-11-03T18:21:26.12`
+# or with a `Z`/offset suffix. Those are parsed here directly; anything else
+# falls back to dateutil.
+FIXED_FORMAT = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d{1,6})\d*)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+
+UTC = datetime.timezone.utc
+
+
+def parse_fixed_format(value):
+    """ Returns an aware datetime for `value` if it is in the fixed format,
+    otherwise None. Naive timestamps are taken to be UTC. """
+    if not isinstance(value, str):
+        return None
+    match = FIXED_FORMAT.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    if offset is None or offset == 'Z':
+        tzinfo = UTC
+    else:
+        sign = -1 if offset[0] == '-' else 1
+        offset = offset[1:].replace(':', '')
+        delta = datetime.timedelta(hours=int(offset[:2]), minutes=int(offset[2:]))
+        tzinfo = datetime.timezone(sign * delta)
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                 int(fraction.ljust(6, '0')) if fraction else 0, tzinfo)
+    except ValueError:
+        return None
+
+
+def format_like(value, template, default_format):
+    """ Writes the aware datetime `value` the way `template` is written: the
+    same separator, fraction digits and offset, in the template's time zone.
+    Templates not in the fixed format get `default_format`, in UTC. """
+    match = FIXED_FORMAT.match(template) if isinstance(template, str) else None
+    if match is None:
+        return value.astimezone(UTC).strftime(default_format)
+    offset = match.group(8) or ''
+    local = value.astimezone(parse_fixed_format(template).tzinfo)
+    text = local.strftime('%Y-%m-%d{separator}%H:%M:%S'.format(separator=template[10]))
+    digits = len(template) - len(offset) - 20 if match.group(7) else 0
+    if digits:
+        text += '.' + '{:06d}'.format(local.microsecond).ljust(digits, '0')[:digits]
+    return text + offset
+
+
+def parse_datetime(value):
+    """ Returns an aware datetime for any string dateutil understands, or None
+    when `value` is not a date. Naive timestamps are taken to be UTC. """
+    parsed = parse_fixed_format(value)
+    if parsed is not None or not isinstance(value, str):
+        return parsed
+    from dateutil.parser import parse
+    try:
+        parsed = parse(value)
+    except (ValueError, OverflowError):
+        return None
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=UTC)
+
+
+class TimestampParser(object):
+    """ Remembers the last value it parsed; the same row value is compared
+    against the bookmark and then written as the bookmark. """
+
+    def __init__(self):
+        self._value = None
+        self._parsed = None
+
+
+    def parse(self, value):
+        if value is not self._value:
+            self._value = value
+            self._parsed = parse_datetime(value)
+        return self._parsed
@@ -0,0 +1,135 @@
+import copy
+
+from singer import metadata
+from singer import Transformer
+from singer.utils import strftime
+from tap_clubspeed.timestamps import parse_fixed_format, UTC
+
+
+# Python types whose values singer's Transformer passes through unchanged
+# (apart from the int -> float widening for numbers).
+FAST_TYPES = {
+    'integer': (int,),
+    'number': (int, float),
+    'string': (str,),
+    'boolean': (bool,)
+}
+
+
+# Per-field conversion goes through parts of singer's Transformer that are
+# not documented: `transform_recur` and the `errors`, `filtered` and `removed`
+# it collects. They are the same from singer-python 5.1.5 on; if a release
+# lacks them, whole records go through `Transformer.transform` instead.
+TRANSFORMER_ATTRIBUTES = ('errors', 'filtered', 'removed')
+
+
+def supports_field_transforms(transformer):
+    return (callable(getattr(transformer, 'transform_recur', None))
+            and all(hasattr(transformer, name) for name in TRANSFORMER_ATTRIBUTES))
+
+
+def is_field_dropped(mdata, field_name):
+    """ Whether the catalog leaves `field_name` out of the stream's records. """
+    breadcrumb = ('properties', field_name)
+    if metadata.get(mdata, breadcrumb, 'inclusion') == 'automatic':
+        return False
+    return (metadata.get(mdata, breadcrumb, 'selected') is False
+            or metadata.get(mdata, breadcrumb, 'inclusion') == 'unsupported')
+
+
+class RecordTransformer(object):
+    """ Transforms the records of one catalog stream.
+
+    The schema, metadata map and the per-field conversion plan are computed once
+    when the stream starts. A field whose value already has the exact Python type
+    its schema asks for is copied as is, and fixed-format timestamps are
+    converted without dateutil. Any other value goes through singer's
+    Transformer for that field only, and if that fails the whole record is run
+    through the Transformer so the error it raises is unchanged. Without the
+    Transformer internals this relies on, every record is transformed whole. """
+
+    def __init__(self, catalog_stream):
+        self.schema = catalog_stream.schema.to_dict()
+        self.mdata = metadata.to_map(catalog_stream.metadata)
+        self.transformer = Transformer()
+        self.dropped = set()
+        self.fields = {}
+        self.per_field = supports_field_transforms(self.transformer)
+        if not self.per_field:
+            return
+        for field_name, field_schema in self.schema.get('properties', {}).items():
+            if self._is_dropped(field_name):
+                self.dropped.add(field_name)
+            else:
+                self.fields[field_name] = self._compile_field(field_name, field_schema)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.transformer.log_warning()
+
+
+    def _is_dropped(self, field_name):
+        return is_field_dropped(self.mdata, field_name)
+
+
+    def _compile_field(self, field_name, field_schema):
+        # transform_recur reorders the type list of the schema it is given,
+        # so the field keeps a private copy.
+        field_schema = copy.deepcopy(field_schema)
+        types = field_schema.get('type', [])
+        types = [types] if not isinstance(types, list) else types
+        non_null = [t for t in types if t != 'null']
+        fast_types = None
+        if len(non_null) == 1 and 'format' not in field_schema and 'anyOf' not in field_schema:
+            fast_types = FAST_TYPES.get(non_null[0])
+        widen = non_null == ['number']
+        datetimes = non_null == ['string'] and field_schema.get('format') == 'date-time'
+
+        # Whatever the Transformer makes of a null is constant for the field.
+        null_success, null_value = self._transform_field(None, field_name, field_schema)
+
+        def convert(value):
+            if value is None and null_success:
+                return True, null_value
+            if fast_types is not None and type(value) in fast_types: # pylint: disable=unidiomatic-typecheck
+                return True, float(value) if widen else value
+            if datetimes:
+                parsed = parse_fixed_format(value)
+                if parsed is not None:
+                    return True, strftime(parsed.astimezone(UTC))
+            return self._transform_field(value, field_name, field_schema)
+
+        return convert
+
+
+    def _transform_field(self, value, field_name, field_schema):
+        errors = len(self.transformer.errors)
+        success, value = self.transformer.transform_recur(value, field_schema, [field_name])
+        del self.transformer.errors[errors:]
+        return success, value
+
+
+    def transform(self, record):
+        if not self.per_field:
+            return self.transformer.transform(dict(record), self.schema, self.mdata)
+        result = {}
+        for field_name, value in record.items():
+            convert = self.fields.get(field_name)
+            if convert is None:
+                if field_name in self.dropped:
+                    self.transformer.filtered.add(field_name)
+                else:
+                    self.transformer.removed.add(field_name)
+                continue
+            success, result[field_name] = convert(value)
+            if not success:
+                return self._transform_slow(record)
+        return result
+
+
+    def _transform_slow(self, record):
+        return Transformer().transform(dict(record), self.schema, self.mdata)
@@ -1,35 +1,282 @@
+import asyncio
+import datetime
+import decimal
+import gzip
+import io
+import os
+import tempfile
+import time
 import itertools
+import json
+import requests
 import unittest
+import urllib.parse
+from unittest import mock
 import tap_clubspeed.streams as streams
+import tap_clubspeed.json_stream as json_stream
+import tap_clubspeed.pipeline as pipeline
 
-from tap_clubspeed.streams import Stream
-from tap_clubspeed.clubspeed import Clubspeed
+from tap_clubspeed.streams import Stream, SyncOptions
+from tap_clubspeed import do_sync, do_sync_tenants, get_tenant_configs
+from tap_clubspeed.clubspeed import Clubspeed, PageSize
+from tap_clubspeed.discover import discover_streams
+from tap_clubspeed.async_client import AsyncClubspeed, BlockingClient
+from tap_clubspeed.cassette import build_response, CassetteMissError
+from tap_clubspeed.rate_limit import RateLimiter
+from tap_clubspeed.retry import CircuitOpenError, RequestBudgetExceeded
+from tap_clubspeed.run_metrics import RUN_METRICS, PHASES
+from tap_clubspeed.sync import sync_stream, MessageWriter, StateFlushPolicy
+from tap_clubspeed.transform import RecordTransformer, supports_field_transforms
+from tap_clubspeed.timestamps import parse_datetime, parse_fixed_format, UTC
+from singer import metadata, Transformer, StateMessage
+from singer.transform import SchemaMismatch
 from singer.catalog import Catalog
 from singer.schema import Schema
 from singer.utils import strftime
 
 
+class FakeResponse(object):
+    def __init__(self, body, status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(body).encode()
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size=1):
+        for index in range(0, len(self.content), 7):
+            yield self.content[index:index + 7]
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(str(self.status_code))
+
+
 class TestClubspeed(unittest.TestCase):
     def test_construct_endpoint(self):
         client = Clubspeed("subdomain", "private_key")
         endpoint = "https://subdomain.clubspeedtiming.com/api/index.php/path.json?key=private_key"
-        self.assertEqual(endpoint, client._construct_endpoint('path'))
+        self.assertEqual(endpoint, client._request_spec('path').url())
 
     def test_pagination(self):
         client = Clubspeed("subdomain", "private_key")
-        endpoint = client._construct_endpoint('path')
-        paginated_endpoint = endpoint + '&page=0&limit=100'
-        self.assertEqual(paginated_endpoint, client._set_page_in_endpoint(endpoint))
-        next_paginated_endpoint = endpoint + '&page=1&limit=100'
-        self.assertEqual(next_paginated_endpoint, client._set_page_in_endpoint(paginated_endpoint, 1))
+        spec = client._request_spec('path')
+        endpoint = spec.url()
+        self.assertEqual(endpoint + '&page=0&limit=100', spec.url(0, 100))
+        self.assertEqual(endpoint + '&page=1&limit=100', spec.url(1, 100))
+
+    def test_session_is_pooled_and_shared(self):
+        client = Clubspeed("subdomain", "private_key", pool_size=4, read_timeout=30)
+        adapter = client.session.get_adapter(client.base_url)
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual((10.0, 30.0), client.timeout)
+        self.assertEqual(0, client.connection_stats()['connections_opened'])
+
+        session = requests.Session()
+        self.assertIs(session, Clubspeed("subdomain", "private_key", session=session).session)
+
+    def test_prefetch_pages_in_order(self):
+        client = Clubspeed("subdomain", "private_key", prefetch_pages=4)
+        client._limit = 2
+        pages = {0: [1, 2], 1: [3, 4], 2: [5]}
+        requested = []
+
+        def fake_request(url, stream=False, endpoint=None):
+            page = int(url.split('page=')[1].split('&')[0])
+            requested.append(page)
+            return FakeResponse(pages.get(page, []))
+
+        client._request = fake_request
+        spec = client._request_spec('path')
+        self.assertEqual([1, 2, 3, 4, 5], list(client._get_response(spec)))
+        self.assertTrue(max(requested) < 3 + 4)
+
+    def test_adaptive_page_size(self):
+        client = Clubspeed("subdomain", "private_key", adaptive_page_size=True,
+                           min_page_size=2, page_size=2, max_page_size=8)
+        rows = list(range(23))
+        requested = []
+
+        def fake_request(url, stream=False, endpoint=None):
+            page = int(url.split('page=')[1].split('&')[0])
+            limit = int(url.split('limit=')[1].split('&')[0])
+            requested.append((page, limit))
+            return FakeResponse(rows[page * limit:(page + 1) * limit])
+
+        client._request = fake_request
+        page_size = client.page_size_for('path')
+        spec = client._request_spec('path')
+        self.assertEqual(rows, list(client._get_response(spec, page_size=page_size)))
+        self.assertEqual([(0, 2), (1, 2), (1, 4), (1, 8), (2, 8), (3, 8)], requested)
+        self.assertEqual(8, page_size.limit)
+        self.assertEqual(4, client.page_size_for('path', learned_limit=4).limit)
+
+    def test_stream_json(self):
+        client = Clubspeed("subdomain", "private_key", stream_json=True)
+        client._limit = 2
+        pages = [{'count': [1, {"a": "]"}], 'checks': [{'checkId': 1}, {'checkId': 2}]},
+                 {'checks': [{'checkId': 3, 'name': "caf\u00e9 \\ \"x\""}]}]
+
+        def fake_request(url, stream=False, endpoint=None):
+            self.assertTrue(stream)
+            page = int(url.split('page=')[1].split('&')[0])
+            return FakeResponse(pages[page] if page < len(pages) else {'checks': []})
+
+        client._request = fake_request
+        spec = client._request_spec('checks')
+        RUN_METRICS.reset()
+        rows = list(client._get_response(spec, 'checks'))
+        self.assertEqual([1, 2, 3], [row['checkId'] for row in rows])
+        self.assertEqual((3, 3), (RUN_METRICS.page_rows[('checks', None)].count,
+                                  RUN_METRICS.page_rows[('checks', None)].sum))
+        sizes = [len(FakeResponse(body).content) for body in pages + [{'checks': []}]]
+        self.assertEqual(sum(sizes), RUN_METRICS.counters[('bytes', 'checks', None)])
+        self.assertEqual('caf\u00e9 \\ "x"', rows[2]['name'])
+
+        with self.assertRaises(KeyError):
+            list(json_stream.iter_rows([b'{"other": []}'], 'checks'))
+        self.assertEqual([12345, 6], list(json_stream.iter_rows([b'[123', b'45,6]'])))
+
+    def test_heat_details_batches(self):
+        client = Clubspeed("subdomain", "private_key", heat_batch_size=4, heat_detail_workers=3)
+        heat_ids = list(range(10))
+        self.assertEqual([4, 4, 2], [len(spec.where['$or']) for spec in client._heat_details_specs(heat_ids)])
+
+        client._max_url_length = len(client._heat_details_spec([1, 2]).url()) + 32
+        self.assertEqual([2, 2, 2, 2, 2], [len(spec.where['$or']) for spec in client._heat_details_specs(heat_ids)])
+
+        def fake_request(url, stream=False, endpoint=None):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            if query['page'] != ['0']:
+                return FakeResponse([])
+            heat_ids = [condition['heatId'] for condition in json.loads(query['where'][0])['$or']]
+            return FakeResponse([{'heatId': heat_id} for heat_id in heat_ids])
+
+        client._request = fake_request
+        self.assertEqual(heat_ids, [row['heatId'] for row in client.heat_main_details(heat_ids=heat_ids)])
+
+    def test_serial_heat_details_batches_page_from_start(self):
+        client = Clubspeed("subdomain", "private_key", page_size=2, heat_batch_size=3)
+
+        # Three rows per heat, so every batch spans several pages.
+        def fake_request(url, stream=False, endpoint=None):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            page, limit = int(query['page'][0]), int(query['limit'][0])
+            heat_ids = [condition['heatId'] for condition in json.loads(query['where'][0])['$or']]
+            rows = [{'heatId': heat_id, 'lap': lap} for heat_id in heat_ids for lap in range(3)]
+            return FakeResponse(rows[page * limit:(page + 1) * limit])
+
+        client._request = fake_request
+        rows = list(client.heat_main_details(page_size=client.page_size_for('heat_main_details'),
+                                             heat_ids=list(range(7))))
+        self.assertEqual([(heat_id, lap) for heat_id in range(7) for lap in range(3)],
+                         [(row['heatId'], row['lap']) for row in rows])
+
+    @mock.patch('time.sleep')
+    def test_retries_with_backoff(self, sleep):
+        client = Clubspeed("subdomain", "private_key", page_size=2, circuit_breaker_threshold=3)
+        client.session = mock.Mock(adapters={})
+        client.session.get.side_effect = [
+            FakeResponse([], 429, {'Retry-After': '7'}),
+            requests.exceptions.ConnectionError('reset'),
+            FakeResponse([{'userId': 1}, {'userId': 2}]),
+            FakeResponse([], 500), FakeResponse([], 500), FakeResponse([], 500),
+        ]
+        users = client.users()
+        self.assertEqual([1, 2], [next(users)['userId'], next(users)['userId']])
+        self.assertEqual(7, sleep.call_args_list[0][0][0])
+
+        # The third 500 in a row opens the circuit instead of being retried.
+        with self.assertRaises(CircuitOpenError):
+            next(users)
+        self.assertEqual(4, client.connection_stats()['retries'])
+        self.assertEqual(6, client.connection_stats()['requests'])
+
+        client = Clubspeed("subdomain", "private_key", page_size=2, max_retries=1)
+        client.session = mock.Mock(adapters={})
+        client.session.get.side_effect = [FakeResponse([], 500), FakeResponse([], 500), FakeResponse([{'userId': 3}]), FakeResponse([])]
+        self.assertEqual([3], [row['userId'] for row in client.users()])
+        self.assertEqual(1, client.connection_stats()['skipped_pages'])
+
+        client = Clubspeed("subdomain", "private_key", max_requests=1)
+        client.session = mock.Mock(adapters={})
+        client.session.get.return_value = FakeResponse([], 503)
+        with self.assertRaises(RequestBudgetExceeded):
+            list(client.users())
+
+    def test_streamed_page_holds_in_flight_slot(self):
+        responses = [FakeResponse({}, 500), FakeResponse({}, 429),
+                     FakeResponse({'checks': [{'checkId': 1}, {'checkId': 2}]}), FakeResponse({'checks': []})]
+        session = mock.Mock()
+        session.get.side_effect = lambda url, **kwargs: responses.pop(0)
+        client = Clubspeed("subdomain", "private_key", session=session, stream_json=True, backoff_factor=0,
+                           requests_per_second=100, max_in_flight=1)
+        client._limit = 2
+        rows = client._get_response(client._request_spec('checks'), 'checks')
+
+        # The 500 leaves the rate alone, the 429 halves it and the 200 wins back a step.
+        next(rows)
+        self.assertEqual(55, client.rate_limiter.stats()['rate'])
+        self.assertFalse(client.rate_limiter._slots.acquire(blocking=False))
+        self.assertEqual([2], [row['checkId'] for row in rows])
+        self.assertTrue(client.rate_limiter._slots.acquire(blocking=False))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=50, burst=1, max_in_flight=2)
+        started = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release()
+        self.assertGreaterEqual(time.monotonic() - started, 4 / 50.0)
+        self.assertGreater(limiter.stats()['wait_seconds'], 0)
+
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(25, limiter.stats()['rate'])
+        limiter.acquire()
+        limiter.release()
+        self.assertEqual(27.5, limiter.stats()['rate'])
+
+        limiter.acquire()
+        limiter.acquire()
+        self.assertFalse(limiter._slots.acquire(blocking=False))
+        limiter.release()
+        limiter.release()
+
+    def test_auth_probe_and_cached_discovery(self):
+        client = Clubspeed("subdomain", "private_key")
+        urls = []
+
+        def fake_request(url, stream=False, endpoint=None):
+            urls.append(url)
+            return FakeResponse([])
+
+        client._request = fake_request
+        client.is_authorized()
+        self.assertTrue(urls[0].endswith('&page=0&limit=1'))
+
+        first = discover_streams(None)
+        first[0]['schema']['properties'].clear()
+        self.assertNotEqual({}, discover_streams(None)[0]['schema']['properties'])
 
     def test_add_filter(self):
         client = Clubspeed("subdomain", "private_key")
-        endpoint = client._construct_endpoint('path')
-        filtered_endpoint_v2 = endpoint + '&where={"column_name":{"$gt":"bookmark"}}&order=column_name ASC'
-        self.assertEqual(filtered_endpoint_v2, client._add_filter(endpoint, 'V2', 'column_name', 'bookmark'))
-        filtered_endpoint_v1 = endpoint + '&filter=column_name > bookmark&order=column_name ASC'
-        self.assertEqual(filtered_endpoint_v1, client._add_filter(endpoint, 'V1', 'column_name', 'bookmark'))
+        endpoint = client._request_spec('path').url()
+        bookmark = '2018-11-03 18:21:26'
+        filtered_endpoint_v2 = endpoint + ('&where=%7B%22column_name%22%3A%7B%22%24gt%22%3A%222018-11-03%2018%3A21%3A26%22%7D%7D'
+                                           '&order=column_name%20ASC')
+        self.assertEqual(filtered_endpoint_v2, client._request_spec('path', 'V2', 'column_name', bookmark).url())
+        filtered_endpoint_v1 = endpoint + '&filter=column_name%20%3E%202018-11-03%2018%3A21%3A26&order=column_name%20ASC'
+        self.assertEqual(filtered_endpoint_v1, client._request_spec('path', 'V1', 'column_name', bookmark).url())
+        spec = client._request_spec('path', 'V1', 'column_name', bookmark, '2018-11-04 00:00:00')
+        self.assertEqual('column_name > 2018-11-03 18:21:26 AND column_name <= 2018-11-04 00:00:00', spec.filter)
+        spec = client._request_spec('path', 'V2', 'column_name', None, '2018-11-04 00:00:00')
+        self.assertEqual({'column_name': {'$lte': '2018-11-04 00:00:00'}}, spec.where)
 
 
 class TestStreams(unittest.TestCase):
@@ -38,6 +285,14 @@ class TestStreams(unittest.TestCase):
         self.assertFalse(streams.needs_parse_to_date(1))
         self.assertFalse(streams.needs_parse_to_date('this_should_fail'))
 
+    def test_parse_datetime(self):
+        expected = datetime.datetime(2011, 11, 3, 18, 21, 26, 500000, tzinfo=datetime.timezone.utc)
+        self.assertEqual(expected, parse_datetime('2011-11-03 18:21:26.5'))
+        self.assertEqual(expected, parse_datetime('2011-11-03T13:21:26.500-05:00'))
+        self.assertEqual(expected, parse_datetime('Nov 3 2011 18:21:26.5'))
+        self.assertIsNone(parse_fixed_format('Nov 3 2011 18:21:26.5'))
+        self.assertIsNone(parse_datetime(5))
+
     def test_is_bookmark_old(self):
         bookmarks = {
             "bookmarks": {
@@ -81,6 +336,546 @@ class TestStreams(unittest.TestCase):
 
 
 
+class TestCassette(unittest.TestCase):
+    def test_record_then_replay(self):
+        pages = [[{'taxId': 1}, {'taxId': 2}], []]
+
+        def fake_send(session, method, url, *args, **kwargs):
+            page = int(url.split('page=')[1].split('&')[0])
+            return build_response({'status': 200, 'body': json.dumps({'taxes': pages[page]})}, url)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'taxes.cassette.gz')
+            client = Clubspeed("subdomain", "secret", cassette_mode='record', cassette_path=path)
+            with mock.patch('requests.Session.request', fake_send):
+                self.assertEqual(2, len(list(client.taxes())))
+            client.close()
+
+            with gzip.open(path, 'rt') as f:
+                self.assertNotIn('secret', f.read())
+
+            client = Clubspeed("subdomain", "other", cassette_mode='replay', cassette_path=path)
+            self.assertEqual([1, 2], [row['taxId'] for row in client.taxes()])
+            with self.assertRaises(CassetteMissError):
+                list(client.users())
+
+
+class FakeAsyncResponse(object):
+    def __init__(self, body, status=200):
+        self.status = status
+        self.headers = {}
+        self._content = json.dumps(body).encode()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return self._content
+
+
+class FakeAsyncSession(object):
+    def __init__(self, respond):
+        self.respond = respond
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        return self.respond(query)
+
+    async def close(self):
+        pass
+
+
+class TestAsyncClient(unittest.TestCase):
+    def test_pages_concurrently_on_one_loop(self):
+        rows = [{'userId': user_id} for user_id in range(7)]
+        failures = [(1, 503)]
+
+        def respond(query):
+            page, limit = int(query.get('page', [0])[0]), int(query.get('limit', [100])[0])
+            if failures and failures[0][0] == page:
+                return FakeAsyncResponse({}, failures.pop()[1])
+            return FakeAsyncResponse(rows[page * limit:(page + 1) * limit])
+
+        session = FakeAsyncSession(respond)
+        client = AsyncClubspeed("subdomain", "private_key", session=session, page_size=2, prefetch_pages=3,
+                                backoff_factor=0)
+
+        async def read_all():
+            user_ids = []
+            async for row in client.users():
+                user_ids.append(row['userId'])
+            return user_ids
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(list(range(7)), loop.run_until_complete(read_all()))
+        finally:
+            loop.close()
+        self.assertEqual(1, client.connection_stats()['retries'])
+
+        blocking = BlockingClient(AsyncClubspeed("subdomain", "private_key", session=session, page_size=2))
+        try:
+            response = blocking.users()
+            self.assertEqual([0, 1], [next(response)['userId'], next(response)['userId']])
+            self.assertEqual((True, (0, 2)), (response.page_complete, response.position))
+            self.assertEqual([2, 3, 4, 5, 6], [row['userId'] for row in response])
+            self.assertEqual([{'userId': 0}], blocking.is_authorized()[:1])
+        finally:
+            blocking.close()
+
+    def test_cancelled_prefetch_frees_slots(self):
+        def respond(query):
+            page, limit = int(query['page'][0]), int(query['limit'][0])
+            return FakeAsyncResponse([{'userId': user_id} for user_id in range(3)][page * limit:(page + 1) * limit])
+
+        client = AsyncClubspeed("subdomain", "private_key", session=FakeAsyncSession(respond), page_size=2,
+                                prefetch_pages=4, max_in_flight=3, requests_per_second=20, rate_limit_burst=1)
+
+        # Each table ends on its second page, cancelling the requests
+        # prefetched behind it while they wait for a token.
+        async def read_tables():
+            tables = []
+            for _ in range(4):
+                tables.append([])
+                async for row in client.users():
+                    tables[-1].append(row['userId'])
+            await asyncio.sleep(0)
+            return tables
+
+        loop = asyncio.new_event_loop()
+        try:
+            tables = loop.run_until_complete(asyncio.wait_for(read_tables(), 10))
+        finally:
+            loop.close()
+        self.assertEqual([[0, 1, 2]] * 4, tables)
+        self.assertEqual(3, client._slots._value)
+
+        for option in ('adaptive_page_size', 'stream_json'):
+            with self.assertRaises(ValueError):
+                AsyncClubspeed("subdomain", "private_key", session=FakeAsyncSession(respond), **{option: True})
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.calls = []
+        self.tax_rows = [{'taxId': 1}]
+
+    def page_size_for(self, stream_name, learned_limit=None):
+        return PageSize()
+
+    def is_authorized(self):
+        return True
+
+    def connection_stats(self):
+        return {'requests': 0, 'connections_opened': 0, 'connections_reused': 0, 'retries': 0, 'skipped_pages': 0,
+                'request_rate': None, 'rate_limit_wait_seconds': 0.0}
+
+    def heat_main(self, column_name=None, bookmark=None, page_size=None, fields=None):
+        for heat_id in range(3):
+            self.calls.append('heat_main')
+            yield {'heatId': heat_id, 'finish': '2018-11-0{}T00:00:00Z'.format(heat_id + 1)}
+
+    def heat_main_details(self, column_name=None, bookmark=None, page_size=None, heat_ids=(), fields=None):
+        for heat_id in heat_ids:
+            self.calls.append('heat_main_details')
+            yield {'heatId': heat_id}
+
+    def taxes(self, column_name=None, bookmark=None, page_size=None, fields=None):
+        self.calls.append('taxes')
+        for row in self.tax_rows:
+            yield dict(row)
+
+
+def make_catalog(*stream_names):
+    catalog = Catalog.from_dict({'streams': discover_streams(None)})
+    for stream in catalog.streams:
+        if stream.tap_stream_id in stream_names:
+            stream.metadata[0]['metadata']['selected'] = True
+    return catalog
+
+
+class TestSync(unittest.TestCase):
+    def test_concurrent_sync_respects_dependencies(self):
+        client = FakeClient()
+        catalog = make_catalog('heat_main', 'heat_main_details', 'taxes')
+        state = {}
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            do_sync(client, catalog, state, {'max_stream_workers': 3})
+
+        heat_calls = [c for c in client.calls if c.startswith('heat')]
+        self.assertEqual(['heat_main'] * 3 + ['heat_main_details'] * 3, heat_calls)
+        self.assertEqual('2018-11-03T00:00:00Z', state['bookmarks']['heat_main']['finish'])
+        self.assertEqual([], state['bookmarks']['heat_main_details']['pending_heat_ids'])
+        messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(7, len([m for m in messages if m['type'] == 'RECORD']))
+
+    def test_sync_tenants(self):
+        config = {'tenants': [{'subdomain': 'track-a', 'private_key': 'a'},
+                              {'name': 'b', 'subdomain': 'track-b', 'private_key': 'b', 'page_size': 50,
+                               'full_table_delta': 'table'}],
+                  'page_size': 20, 'max_tenant_workers': 2}
+        tenant_configs = get_tenant_configs(config)
+        self.assertEqual(['track-a', 'b'], [name for name, _ in tenant_configs])
+        self.assertEqual([20, 50], [tenant_config['page_size'] for _, tenant_config in tenant_configs])
+
+        tenants = [(name, tenant_config, FakeClient()) for name, tenant_config in tenant_configs]
+        state = {}
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            do_sync_tenants(tenants, make_catalog('heat_main', 'heat_main_details'), state, config)
+
+        messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        schemas = [m for m in messages if m['type'] == 'SCHEMA']
+        self.assertEqual(2, len(schemas))
+        self.assertEqual(['_sdc_tenant', 'heatId'], schemas[0]['key_properties'])
+        records = [m['record'] for m in messages if m['type'] == 'RECORD' and m['stream'] == 'heat_main']
+        self.assertEqual(['b'] * 3 + ['track-a'] * 3, sorted(record['_sdc_tenant'] for record in records))
+        for tenant in ('track-a', 'b'):
+            self.assertEqual('2018-11-03T00:00:00Z', state['tenants'][tenant]['bookmarks']['heat_main']['finish'])
+        self.assertEqual(state, messages[-1]['value'])
+
+        # Only tenant b skips an unchanged table on the second run.
+        for _ in range(2):
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                do_sync_tenants(tenants, make_catalog('taxes'), state, config)
+        records = [json.loads(line)['record'] for line in stdout.getvalue().splitlines() if '"RECORD"' in line]
+        self.assertEqual(['track-a'], [record['_sdc_tenant'] for record in records])
+
+    def test_pending_heat_ids_survive_failed_details_sync(self):
+        self.assertEqual([[1, 3], [7, 7]], streams.compress_ids([3, 1, 2, 7, 2]))
+        self.assertEqual([1, 2, 3, 7], streams.expand_ids([[1, 3], [7, 7]]))
+
+        client = FakeClient()
+        catalog = make_catalog('heat_main', 'heat_main_details')
+        state = {}
+        with mock.patch('sys.stdout', new_callable=io.StringIO), \
+             mock.patch.object(FakeClient, 'heat_main_details', side_effect=IOError('unavailable')):
+            with self.assertRaises(IOError):
+                do_sync(client, catalog, state)
+        self.assertEqual([[0, 2]], state['bookmarks']['heat_main_details']['pending_heat_ids'])
+
+        # A later run syncs only heat_main_details from the queued IDs.
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            do_sync(client, make_catalog('heat_main_details'), state)
+        self.assertEqual(['heat_main_details'] * 3, [c for c in client.calls if c == 'heat_main_details'])
+        self.assertEqual([], state['bookmarks']['heat_main_details']['pending_heat_ids'])
+
+    def test_heat_ids_queued_only_when_details_selected(self):
+        client = FakeClient()
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            do_sync(client, make_catalog('heat_main', 'heat_main_details'), {})
+            state = {}
+            do_sync(client, make_catalog('heat_main'), state)
+        self.assertNotIn('heat_main_details', state['bookmarks'])
+
+    def test_unordered_heat_details_keep_queue_until_complete(self):
+        for ordered, expected in [(True, [[[0, 2]], [[1, 2]], [[2, 2]], []]), (False, [[[0, 2]]] * 3 + [[]])]:
+            client = FakeClient()
+            client.heat_details_ordered = ordered
+            instance = streams.HeatMainDetails(client)
+            instance.stream = make_catalog('heat_main_details').get_stream('heat_main_details')
+            state = {'bookmarks': {'heat_main_details': {'pending_heat_ids': [[0, 2]]}}}
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                sync_stream(state, instance, flush_policy=StateFlushPolicy(every_records=1, every_seconds=3600))
+
+            messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+            queues = [m['value']['bookmarks']['heat_main_details']['pending_heat_ids']
+                      for m in messages if m['type'] == 'STATE']
+            self.assertEqual(expected, queues)
+
+    def test_state_flushed_every_n_records(self):
+        catalog = make_catalog('heat_main')
+        instance = streams.HeatMain(FakeClient())
+        instance.stream = catalog.get_stream('heat_main')
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            sync_stream({}, instance, flush_policy=StateFlushPolicy(every_records=2, every_seconds=3600))
+
+        types = [json.loads(line)['type'] for line in stdout.getvalue().splitlines()]
+        self.assertEqual(['RECORD', 'RECORD', 'STATE', 'RECORD', 'STATE'], types)
+
+
+    def test_resumes_from_page_cursor(self):
+        rows = [{'taxId': tax_id} for tax_id in range(7)]
+        failing_pages = [3]
+
+        def fake_request(url, stream=False, endpoint=None):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            page, limit = int(query['page'][0]), int(query['limit'][0])
+            if page in failing_pages:
+                raise IOError('connection reset')
+            return FakeResponse({'taxes': rows[page * limit:(page + 1) * limit]})
+
+        client = Clubspeed("subdomain", "private_key", page_size=2)
+        client._request = fake_request
+        instance = streams.Taxes(client)
+        instance.stream = make_catalog('taxes').get_stream('taxes')
+        state = {'bookmarks': {'taxes': {'page_cursor': {'filter': None, 'page': 1, 'limit': 2}}}}
+        with mock.patch('sys.stdout', new_callable=io.StringIO), self.assertRaises(IOError):
+            sync_stream(state, instance)
+        self.assertEqual({'filter': None, 'page': 3, 'limit': 2}, state['bookmarks']['taxes']['page_cursor'])
+
+        instance = streams.Taxes(client)
+        instance.stream = make_catalog('taxes').get_stream('taxes')
+        failing_pages.pop()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            sync_stream(state, instance)
+        records = [json.loads(line)['record'] for line in stdout.getvalue().splitlines() if '"RECORD"' in line]
+        self.assertEqual([6], [record['taxId'] for record in records])
+        self.assertNotIn('page_cursor', state['bookmarks']['taxes'])
+
+
+    def test_backfill_in_windows(self):
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        # Four rows a day, so every window spans several pages.
+        rows = [{'checkId': index, 'closedDate': strftime(now - datetime.timedelta(hours=6 * (19 - index) + 3))}
+                for index in range(20)]
+        windows = []
+
+        def fake_request(url, stream=False, endpoint=None):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            condition = json.loads(query['where'][0])['closedDate']
+            lower, upper = parse_datetime(condition['$gt']), parse_datetime(condition['$lte'])
+            if query['page'][0] == '0':
+                windows.append((lower, upper))
+            matching = [row for row in rows if lower < parse_datetime(row['closedDate']) <= upper]
+            page, limit = int(query['page'][0]), int(query['limit'][0])
+            return FakeResponse({'checks': matching[page * limit:(page + 1) * limit]})
+
+        for workers in (1, 3):
+            client = Clubspeed("subdomain", "private_key", page_size=2)
+            client._request = fake_request
+            instance = streams.Checks(client)
+            instance.stream = make_catalog('checks').get_stream('checks')
+            instance.options = SyncOptions(backfill_window_days=2, backfill_workers=workers,
+                                           backfill_start_date=strftime(now - datetime.timedelta(days=5)),
+                                           sync_started=now)
+            state = {}
+            del windows[:]
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                sync_stream(state, instance)
+            records = [json.loads(line)['record'] for line in stdout.getvalue().splitlines() if '"RECORD"' in line]
+            self.assertEqual(list(range(20)), [record['checkId'] for record in records])
+            self.assertEqual(3, len(windows))
+            self.assertTrue(all(upper - lower == datetime.timedelta(days=2)
+                                for lower, upper in sorted(windows)[:2]))
+            self.assertEqual(now, max(upper for _, upper in windows))
+            self.assertEqual(rows[-1]['closedDate'], state['bookmarks']['checks']['closedDate'])
+
+        # Bounds are written the way the bookmark is.
+        until = datetime.datetime(2018, 11, 9, 6, 30, 15, 123456, UTC)
+        for bookmark, first, last in [
+                ('2018-11-03T18:21:26.12+01:00', '2018-11-05T18:21:26.12+01:00', '2018-11-09T07:30:15.12+01:00'),
+                ('2018-11-03 18:21:26', '2018-11-05 18:21:26', '2018-11-09 06:30:15'),
+                ('2018-11-03T18:21:26.000000Z', '2018-11-05T18:21:26.000000Z', '2018-11-09T06:30:15.123456Z')]:
+            bounds = streams.backfill_windows(bookmark, until, datetime.timedelta(days=2))
+            self.assertEqual([(bookmark, first), (first, last)], [bounds[0], (bounds[1][0], bounds[-1][1])])
+
+
+    def test_selected_fields_projected_and_pruned(self):
+        urls = []
+
+        def fake_request(url, stream=False, endpoint=None):
+            urls.append(url)
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            rows = [{'checkId': 1, 'closedDate': '2018-11-03 18:21:26', 'total': 5, 'notes': 'x'}]
+            return FakeResponse({'checks': rows if query['page'][0] == '0' else []})
+
+        catalog = make_catalog('checks')
+        stream = catalog.get_stream('checks')
+        for entry in stream.metadata:
+            if entry['breadcrumb'] and entry['breadcrumb'][1] not in ('checkId', 'closedDate'):
+                entry['metadata']['selected'] = False
+
+        client = Clubspeed("subdomain", "private_key", project_fields=True)
+        client._request = fake_request
+        instance = streams.Checks(client)
+        instance.stream = stream
+        records = [record for _, record in instance.sync({})]
+        self.assertEqual([{'checkId': 1, 'closedDate': '2018-11-03 18:21:26'}], records)
+        self.assertIn('&select=checkId%2CclosedDate', urls[0])
+
+        # Without projection the client still prunes each page as it is
+        # decoded, so only selected fields cross the pipeline's queues.
+        queued = []
+        put = pipeline.StageQueue.put
+
+        def record_put(queue, item, timer):
+            queued.append(item[0])
+            return put(queue, item, timer)
+
+        client = Clubspeed("subdomain", "private_key")
+        client._request = fake_request
+        instance = streams.Checks(client)
+        instance.stream = stream
+        with mock.patch('sys.stdout', new_callable=io.StringIO), \
+             mock.patch.object(pipeline.StageQueue, 'put', record_put):
+            sync_stream({}, instance, pipeline_queue_size=2)
+        rows = [item for item in queued if isinstance(item, dict)]
+        self.assertEqual([{'checkId': 1, 'closedDate': '2018-11-03 18:21:26'}], rows)
+
+
+    def test_full_table_delta(self):
+        def synced_tax_ids(client, state, mode):
+            instance = streams.Taxes(client)
+            instance.stream = make_catalog('taxes').get_stream('taxes')
+            instance.options = SyncOptions(mode)
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                sync_stream(state, instance)
+            return [json.loads(line)['record']['taxId'] for line in stdout.getvalue().splitlines() if '"RECORD"' in line]
+
+        client = FakeClient()
+        client.tax_rows = [{'taxId': 1, 'amount': 5}, {'taxId': 2, 'amount': 7}]
+        state = {}
+        self.assertEqual([1, 2], synced_tax_ids(client, state, 'table'))
+        self.assertEqual([], synced_tax_ids(client, state, 'table'))
+        client.tax_rows[1]['amount'] = 8
+        self.assertEqual([1, 2], synced_tax_ids(client, state, 'table'))
+
+        client = FakeClient()
+        client.tax_rows = [{'taxId': 1, 'amount': 5}, {'taxId': 2, 'amount': 7}]
+        state = {}
+        self.assertEqual([1, 2], synced_tax_ids(client, state, 'rows'))
+        client.tax_rows[1]['amount'] = 8
+        client.tax_rows.append({'taxId': 3, 'amount': 1})
+        self.assertEqual([2, 3], synced_tax_ids(client, state, 'rows'))
+        self.assertEqual(3, len(state['bookmarks']['taxes']['row_hashes']))
+
+
+    def test_held_pages_checkpoint_behind_output(self):
+        rows = [{'taxId': tax_id, 'amount': 1} for tax_id in range(7)]
+
+        def fake_request(url, stream=False, endpoint=None):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            page, limit = int(query['page'][0]), int(query['limit'][0])
+            return FakeResponse({'taxes': rows[page * limit:(page + 1) * limit]})
+
+        def sync_messages(state, options):
+            client = Clubspeed("subdomain", "private_key", page_size=2)
+            client._request = fake_request
+            instance = streams.Taxes(client)
+            instance.stream = make_catalog('taxes').get_stream('taxes')
+            instance.options = options
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                sync_stream(state, instance, flush_policy=StateFlushPolicy(every_records=1, every_seconds=3600))
+            return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+        for options in [SyncOptions('table'), SyncOptions('table', full_table_max_held_rows=1)]:
+            state = {}
+            sync_messages(state, options)
+            rows[4]['amount'] = 2
+            messages = sync_messages(state, options)
+            rows[4]['amount'] = 1
+
+            # Pages 0 and 1 are held until page 2 differs; no cursor may
+            # point past a row not yet written.
+            written = 0
+            for message in messages:
+                if message['type'] == 'RECORD':
+                    written += 1
+                cursor = message.get('value', {}).get('bookmarks', {}).get('taxes', {}).get('page_cursor')
+                if cursor:
+                    self.assertLessEqual(min(cursor['page'] * cursor['limit'], len(rows)), written)
+            self.assertEqual(7, written)
+
+    def test_pipelined_sync_matches_serial(self):
+        rows = [{'heatId': heat_id, 'finish': '2018-11-0{}T00:00:00Z'.format(heat_id)} for heat_id in range(1, 6)]
+        failing_pages = []
+
+        def fake_request(url, stream=False, endpoint=None):
+            page = int(urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['page'][0])
+            if page in failing_pages:
+                raise IOError('connection reset')
+            return FakeResponse(rows[page * 2:(page + 1) * 2])
+
+        def sync_output(queue_size):
+            client = Clubspeed("subdomain", "private_key", page_size=2)
+            client._request = fake_request
+            instance = streams.HeatMain(client)
+            instance.stream = make_catalog('heat_main').get_stream('heat_main')
+            state = {}
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                sync_stream(state, instance, pipeline_queue_size=queue_size)
+            return stdout.getvalue(), state
+
+        self.assertEqual(sync_output(0), sync_output(1))
+
+        failing_pages.append(1)
+        with self.assertRaises(IOError):
+            sync_output(1)
+
+    def test_metrics_export(self):
+        client = FakeClient()
+        with tempfile.TemporaryDirectory() as directory:
+            config = {'metrics_textfile': os.path.join(directory, 'tap.prom'),
+                      'metrics_report': os.path.join(directory, 'report.json')}
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                do_sync(client, make_catalog('heat_main'), {}, config)
+                RUN_METRICS.observe_request('heatMain', 'a "b"', 0.3)
+            with open(config['metrics_report']) as f:
+                report = json.load(f)
+            with open(config['metrics_textfile']) as f:
+                textfile = f.read()
+
+        self.assertEqual(3, report['streams'][0]['records'])
+        self.assertEqual(set(PHASES), set(report['streams'][0]['seconds']))
+        self.assertIn('clubspeed_records_total{stream="heat_main"} 3', textfile)
+        self.assertIn('clubspeed_stream_seconds_total{stream="heat_main",phase="bookmark"}', textfile)
+        self.assertIn('clubspeed_request_duration_seconds_bucket{endpoint="heatMain",tenant="a \\"b\\"",le="0.5"} 1',
+                      RUN_METRICS.prometheus())
+
+
+    def test_message_writer_buffers_until_state(self):
+        for threaded in (False, True):
+            writer = MessageWriter(threaded=threaded)
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                writer.write_record('taxes', {'taxId': 1, 'name': 'caf\u00e9'})
+                writer.write_record('taxes', {'taxId': 2, 'amount': decimal.Decimal('1.5')})
+                if not threaded:
+                    self.assertEqual('', stdout.getvalue())
+                writer.write_message(StateMessage(value={'bookmarks': {}}), flush=True)
+                writer.close()
+
+            messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+            self.assertEqual([{'type': 'RECORD', 'stream': 'taxes', 'record': {'taxId': 1, 'name': 'caf\u00e9'}},
+                              {'type': 'RECORD', 'stream': 'taxes', 'record': {'taxId': 2, 'amount': 1.5}},
+                              {'type': 'STATE', 'value': {'bookmarks': {}}}], messages)
+
+
+class TestTransform(unittest.TestCase):
+    def test_matches_singer_transformer(self):
+        catalog = make_catalog('payments')
+        stream = catalog.get_stream('payments')
+        stream.metadata.append({'breadcrumb': ['properties', 'cardType'], 'metadata': {'selected': False}})
+        records = [
+            {'paymentId': 1, 'cardType': 'visa', 'payAmount': 10, 'payDate': '2018-11-03 18:21:26', 'unknown': 1},
+            {'paymentId': '1,000', 'payAmount': '2.5', 'voided': 'false', 'payDate': None},
+            {'paymentId': None, 'payAmount': None, 'voided': None, 'extCardType': 5},
+            {'payDate': '2018-11-03T18:21:26.5-05:00', 'voidDate': '2018-11-03T18:21:26Z'},
+            {'payDate': 'Nov 3 2018 6:21 PM', 'voidDate': ''},
+        ]
+        with RecordTransformer(stream) as transformer:
+            for record in records:
+                with Transformer() as expected:
+                    self.assertEqual(
+                        expected.transform(dict(record), stream.schema.to_dict(), metadata.to_map(stream.metadata)),
+                        transformer.transform(record))
+
+            with self.assertRaises(SchemaMismatch):
+                transformer.transform({'paymentId': 'not a number'})
+
+        # The installed singer-python has the Transformer internals used per
+        # field; without them records are still transformed, whole.
+        self.assertTrue(supports_field_transforms(Transformer()))
+        with mock.patch('tap_clubspeed.transform.supports_field_transforms', return_value=False):
+            with RecordTransformer(stream) as transformer:
+                self.assertEqual({'paymentId': 1, 'payAmount': 2.5}, transformer.transform({'paymentId': 1,
+                                                                                            'payAmount': '2.5'}))
+
+
 if __name__ == '__main__':
     unittest.main()
 